@@ -18,9 +18,15 @@ def preload(parser: ArgumentParser):
         type=str,
         help='Path to directory with Onnyx project(s).'
     )
-    # TODO allow using devices in parallel, specified as comma separed list
     parser.add_argument(
         '--additional-device-ids',
         type=str,
-        help='Device ID to use. cpu:0, gpu:0 or gpu:1, etc.',
+        help='Device ID(s) to use, comma separated: cpu:0, gpu:0 or '
+        'gpu:0,gpu:1, etc. Onnx models get a session per device',
+    )
+    parser.add_argument(
+        '--tagger-preload',
+        type=str,
+        help='Interrogators to load and warm up at startup, comma separated, '
+        'e.g. wd14-vit.v2,wd14-convnext.v2',
     )
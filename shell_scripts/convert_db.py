@@ -0,0 +1,42 @@
+from json import dumps
+from pathlib import Path
+import argparse
+import sys
+
+# convert between the db.json (db_json_v1 schema) and db.sqlite databases of
+# the tagger. The direction follows from the file extensions. Converting to
+# db.sqlite adds the interrogations of the db.json to an existing db.sqlite;
+# they get indices after those in use, and replace those of the same image and
+# interrogator.
+
+# example usage:
+# cd stable-diffusion-webui/extensions/stable-diffusion-webui-wd14-tagger/
+# python shell_scripts/convert_db.py test/db.json test/db.sqlite
+# python shell_scripts/convert_db.py test/db.sqlite exported/db.json
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from tagger.store import SQLiteStore, read_v1  # noqa: E402
+
+desc = 'Convert a tagger db.json to db.sqlite or back'
+parser = argparse.ArgumentParser(description=desc)
+parser.add_argument('source', help='db.json or db.sqlite to read')
+parser.add_argument('dest', help='db.sqlite or db.json to write')
+args = parser.parse_args()
+
+source, dest = Path(args.source), Path(args.dest)
+
+if source.suffix == '.json' and dest.suffix == '.sqlite':
+    store = SQLiteStore(dest)
+    store.import_v1(read_v1(source))
+    print(f'Wrote {dest}: {len(store.query)} interrogations')
+elif source.suffix == '.sqlite' and dest.suffix == '.json':
+    if not source.is_file():
+        print(f'{source}: no such file')
+        exit(1)
+    store = SQLiteStore(source)
+    dest.write_text(dumps(store.export_v1(), indent=2))
+    print(f'Wrote {dest}: {len(store.query)} interrogations')
+else:
+    print('Convert either a .json to a .sqlite or a .sqlite to a .json')
+    exit(1)
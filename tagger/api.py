@@ -1,21 +1,33 @@
 """API module for FastAPI"""
-from typing import Callable, Dict, Optional
-from threading import Lock
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from io import BytesIO
+from threading import Lock, Thread
 from secrets import compare_digest
 import asyncio
 from collections import defaultdict
 from hashlib import sha256
+from json import dumps
+import os
+import re
 import string
 from random import choices
+from time import monotonic
+from glob import glob
 
 from modules import shared  # pylint: disable=import-error
 from modules.api.api import decode_base64_to_image  # pylint: disable=E0401
 from modules.call_queue import queue_lock  # pylint: disable=import-error
-from fastapi import FastAPI, Depends, HTTPException
+from modules.paths import data_path  # pylint: disable=import-error
+from PIL import Image
+from fastapi import FastAPI, Depends, HTTPException, File, Form, UploadFile
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 
 from tagger import utils  # pylint: disable=import-error
 from tagger import api_models as models  # pylint: disable=import-error
+from tagger.batcher import MicroBatcher  # pylint: disable=import-error
+from tagger.manager import manager  # pylint: disable=import-error
+from tagger import quantize  # pylint: disable=import-error
 
 
 class Api:
@@ -30,16 +42,36 @@ class Api:
                 self.credentials[user] = password
 
         self.app = app
-        self.queue: Dict[str, asyncio.Queue] = {}
         self.res: Dict[str, Dict[str, Dict[str, float]]] = \
             defaultdict(dict)
         self.queue_lock = qlock
-        self.tasks: Dict[str, asyncio.Task] = {}
+        # queued images are interrogated in batches per model
+        self.batcher = MicroBatcher(
+            self.interrogate_batch,
+            lambda: getattr(shared.opts, 'tagger_infer_batch_size', 8),
+            lambda: getattr(shared.opts, 'tagger_api_batch_wait', 10) / 1000,
+        )
 
-        self.runner: Optional[asyncio.Task] = None
         self.prefix = prefix
         self.running_batches: Dict[str, Dict[str, float]] = \
             defaultdict(lambda: defaultdict(int))
+        # per queue: images in flight, finished names for a streaming client
+        # and whether the final request was received
+        self.pending: Dict[str, int] = defaultdict(int)
+        # the interrogations in flight per queue and name, the final
+        # request waits for them
+        self.tasks: Dict[str, Dict[str, asyncio.Future]] = \
+            defaultdict(dict)
+        # why an image of a queue was not interrogated, per queue and name
+        self.errors: Dict[str, Dict[str, str]] = defaultdict(dict)
+        self.streams: Dict[str, asyncio.Queue] = {}
+        self.closing = set()
+        # last request per queue, to drop abandoned queues
+        self.last_used: Dict[str, float] = {}
+        # images decoded or in inference, per model
+        self.model_pending: Dict[str, int] = defaultdict(int)
+        # status of the interrogators that are preloaded
+        self.preload: Dict[str, str] = {}
 
         self.add_api_route(
             'interrogate',
@@ -48,6 +80,33 @@ class Api:
             response_model=models.TaggerInterrogateResponse
         )
 
+        self.add_api_route(
+            'interrogate-batch',
+            self.endpoint_interrogate_batch,
+            methods=['POST'],
+            response_model=models.TaggerInterrogateBatchResponse
+        )
+
+        self.add_api_route(
+            'stream/{queue}',
+            self.endpoint_stream,
+            methods=['GET'],
+        )
+
+        self.add_api_route(
+            'readiness',
+            self.endpoint_readiness,
+            methods=['GET'],
+            response_model=models.TaggerReadinessResponse,
+        )
+
+        self.add_api_route(
+            'variant-report',
+            self.endpoint_variant_report,
+            methods=['POST'],
+            response_model=Dict[str, float],
+        )
+
         self.add_api_route(
             'interrogators',
             self.endpoint_interrogators,
@@ -65,70 +124,177 @@ class Api:
     async def add_to_queue(self, m, q, n='', i=None, t=0.0) -> Dict[
         str, Dict[str, float]
     ]:
-        if m not in self.queue:
-            self.queue[m] = asyncio.Queue()
-        #  loop = asyncio.get_running_loop()
-        #  asyncio.run_coroutine_threadsafe(
-        task = asyncio.create_task(self.queue[m].put((q, n, i, t)))
-        #  , loop)
-
-        if self.runner is None:
+        if n == '':
+            return await self.finish_queue(m, q)
+        return await self.do_queued_interrogation(m, q, n, i, t)
+
+    def interrogate_batch(self, m: str, items: List[Tuple]) -> List[
+        Union[Dict[str, Dict[str, float]], Exception]
+    ]:
+        """
+        one inference run for the (image, threshold) queued for m, the
+        exception instead of the result for an image that fails to preprocess
+        """
+        interrogator = utils.interrogators[m]
+        # below the confidence floor, the caller asks for all tags
+        floor = getattr(shared.opts, 'tagger_confidence_floor', 0.005)
+        full = any(t < floor for _, t in items)
+        inputs, errors = [], {}
+        # not unloaded between the preprocessing and the inference
+        with self.queue_lock, manager.use(interrogator):
+            # per image, a broken one fails only its own request
+            for j, (image, _) in enumerate(items):
+                try:
+                    inputs.append(interrogator.preprocess(image))
+                except Exception as err:  # pylint: disable=broad-except
+                    errors[j] = err
+            got = iter(interrogator.run_batch(inputs, full)
+                       if len(inputs) > 0 else [])
+
+        results = []
+        for j, (_, t) in enumerate(items):
+            if j in errors:
+                results.append(errors[j])
+                continue
+            rating, tag = next(got)
+            results.append({
+                "rating": rating,
+                "tag": {k: v for k, v in tag.items() if v > t}
+            })
+        return results
+
+    async def interrogate(self, m, i, t) -> Dict[str, Dict[str, float]]:
+        """ decode in the default executor, infer in the model's batcher """
+        self.model_pending[m] += 1
+        try:
             loop = asyncio.get_running_loop()
-            asyncio.ensure_future(self.batch_process(), loop=loop)
-        await task
-        return await self.tasks[q+"\t"+n]
+            image = await loop.run_in_executor(None, self.decode_base64, i)
+            return await asyncio.wrap_future(self.batcher.submit(m, image, t))
+        finally:
+            self.model_pending[m] -= 1
+
+    def check_limits(self, m: str, images=1, q: Optional[str] = None):
+        """ refuse more images than the configured limits, with a 429 """
+        retry = {"Retry-After": "1"}
+        limit = getattr(shared.opts, 'tagger_api_model_limit', 4096)
+        if 0 < limit < self.model_pending[m] + images:
+            raise HTTPException(429, f'Too many images pending for {m}',
+                                headers=retry)
+        limit = getattr(shared.opts, 'tagger_api_queue_limit', 1024)
+        if q is not None and 0 < limit < len(self.res.get(q, {})) + images:
+            raise HTTPException(429, f'Too many images in queue {q}, stream '
+                                'it or send the final request', headers=retry)
+
+    def evict_expired(self) -> None:
+        """ drop the queues without requests for longer than the ttl """
+        ttl = getattr(shared.opts, 'tagger_api_queue_ttl', 3600)
+        if ttl <= 0:
+            return
+        now = monotonic()
+        expired = [q for q, last in self.last_used.items() if now - last > ttl
+                   and self.pending.get(q, 0) == 0 and q not in self.streams]
+        for q in expired:
+            print(f'WD14 tagger api: dropped abandoned queue {q}')
+            self.drop_queue(q)
+
+    def drop_queue(self, q) -> Optional[Dict[str, Dict[str, float]]]:
+        """ forget a drained queue, return its results """
+        self.last_used.pop(q, None)
+        self.pending.pop(q, None)
+        self.tasks.pop(q, None)
+        self.errors.pop(q, None)
+        for batches in self.running_batches.values():
+            batches.pop(q, None)
+        return self.res.pop(q, None)
 
     async def do_queued_interrogation(self, m, q, n, i, t) -> Dict[
         str, Dict[str, float]
     ]:
         self.running_batches[m][q] += 1.0
-        # queue and name empty to process, not queue
-        res = self.endpoint_interrogate(
-            models.TaggerInterrogateRequest(
-                image=i,
-                model=m,
-                threshold=t,
-                name_in_queue='',
-                queue=''
-            )
-        )
-        self.res[q][n] = res.caption["tag"]
-        for k, v in res.caption["rating"].items():
-            self.res[q][n]["rating:"+k] = v
+        self.pending[q] += 1
+        task = asyncio.ensure_future(self.queued_result(m, q, n, i, t))
+        self.tasks[q][n] = task
+        # shielded: the final request waits for it, also if this one left
+        await asyncio.shield(task)
         return self.running_batches
 
-    async def finish_queue(self, m, q) -> Dict[str, Dict[str, float]]:
-        if q in self.running_batches[m]:
-            del self.running_batches[m][q]
-        if q in self.res:
-            return self.res.pop(q)
-        return self.running_batches
+    async def queued_result(self, m, q, n, i, t) -> None:
+        """ interrogate an image of a queue, keep the result in the queue """
+        try:
+            res = await self.interrogate(m, i, t)
+            if n in self.res.get(q, {}):
+                self.res[q][n] = res["tag"]
+                for k, v in res["rating"].items():
+                    self.res[q][n]["rating:"+k] = v
+        except Exception as err:
+            if n in self.res.get(q, {}):
+                self.errors[q][n] = repr(err)
+            raise
+        finally:
+            self.pending[q] -= 1
+            self.tasks[q].pop(n, None)
+            if q in self.streams:
+                # streamed results are not kept for the final request
+                self.streams[q].put_nowait(n)
 
-    async def batch_process(self) -> None:
-        #  loop = asyncio.get_running_loop()
-        while len(self.queue) > 0:
-            for m in self.queue:
-                # if zero the queue might just be pending
-                while True:
-                    try:
-                        #  q, n, i, t = asyncio.run_coroutine_threadsafe(
-                        #  self.queue[m].get_nowait(), loop).result()
-                        q, n, i, t = self.queue[m].get_nowait()
-                    except asyncio.QueueEmpty:
-                        break
-                    self.tasks[q+"\t"+n] = asyncio.create_task(
-                        self.do_queued_interrogation(m, q, n, i, t) if n != ""
-                        else self.finish_queue(m, q)
-                    )
-
-            for model in self.running_batches:
-                if len(self.running_batches[model]) == 0:
-                    del self.queue[model]
-            else:
-                await asyncio.sleep(0.1)
-
-        self.running_batches.clear()
-        self.runner = None
+    async def finish_queue(self, m, q) -> Dict[str, Dict[str, float]]:
+        # the images still in flight belong to this response
+        await asyncio.gather(*self.tasks.get(q, {}).values(),
+                             return_exceptions=True)
+        if q in self.streams:
+            # the stream drops the queue after its last result
+            self.closing.add(q)
+            self.streams[q].put_nowait(None)
+            return {}
+        if len(self.tasks.get(q, {})) > 0:
+            # images queued since stay, for the next final request
+            done = [n for n in self.res[q] if n not in self.tasks[q]]
+            for n in done:
+                self.errors[q].pop(n, None)
+            return {n: self.res[q].pop(n) for n in done}
+        res = self.drop_queue(q)
+        return self.running_batches if res is None else res
+
+    async def stream_queue(self, q: str, sse: bool):
+        """ yield the results of queue q as they finish, then evict them """
+        stream = self.streams[q]
+        # results that finished before the client connected
+        for n, caption in list(self.res.get(q, {}).items()):
+            if len(caption) > 0 or n in self.errors.get(q, {}):
+                stream.put_nowait(n)
+        try:
+            while True:
+                n = await stream.get()
+                if n is not None and n in self.res.get(q, {}):
+                    item = {"name": n, "caption": self.res[q].pop(n)}
+                    # as the results of interrogate-batch
+                    if n in self.errors.get(q, {}):
+                        item = {"name": n, "error": self.errors[q].pop(n)}
+                    line = dumps(item)
+                    yield f'data: {line}\n\n' if sse else line + '\n'
+                if q in self.closing and self.pending.get(q, 0) == 0 and \
+                        stream.empty():
+                    break
+        finally:
+            del self.streams[q]
+            if q in self.closing and self.pending.get(q, 0) == 0:
+                self.drop_queue(q)
+            self.closing.discard(q)
+
+    async def endpoint_stream(self, queue: str, sse: bool = False):
+        """
+        stream the results of a queue as NDJSON, or server-sent events if
+        sse, until the final (empty name) request for the queue was received.
+        An image that could not be interrogated has an error, no caption.
+        """
+        if queue in self.streams:
+            raise HTTPException(409, 'Queue is already streamed')
+        self.evict_expired()
+        self.streams[queue] = asyncio.Queue()
+        return StreamingResponse(
+            self.stream_queue(queue, sse),
+            media_type='text/event-stream' if sse else 'application/x-ndjson'
+        )
 
     def auth(self, creds: Optional[HTTPBasicCredentials] = None):
         if creds is None:
@@ -158,25 +324,29 @@ class Api:
         str, Dict[str, float]
     ]:
         """ queue an interrogation, or add to batch """
+        self.evict_expired()
         if n == '':
-            task = asyncio.create_task(self.add_to_queue(m, q))
+            return await self.add_to_queue(m, q)
         else:
             if n == '<sha256>':
-                n = sha256(i).hexdigest()
-                if n in self.res[q]:
+                n = sha256(i.encode()).hexdigest()
+                if n in self.res.get(q, {}):
                     return self.running_batches
-            elif n in self.res[q]:
+            elif n in self.res.get(q, {}):
                 # clobber name if it's already in the queue
                 j = 0
                 while f'{n}#{j}' in self.res[q]:
                     j += 1
                 n = f'{n}#{j}'
+            self.check_limits(m, 1, q)
+            self.last_used[q] = monotonic()
             self.res[q][n] = {}
             # add image to queue
-            task = asyncio.create_task(self.add_to_queue(m, q, n, i, t))
-        return await task
+            return await self.add_to_queue(m, q, n, i, t)
 
-    def endpoint_interrogate(self, req: models.TaggerInterrogateRequest):
+    async def endpoint_interrogate(
+        self, req: models.TaggerInterrogateRequest
+    ):
         """ one file interrogation, queueing, or batch results """
         if req.image is None:
             raise HTTPException(404, 'Image not found')
@@ -193,24 +363,140 @@ class Api:
                 while True:
                     q = ''.join(choices(string.ascii_uppercase +
                                 string.digits, k=8))
-                    if q not in self.queue:
+                    if q not in self.res:
                         break
                 print(f'WD14 tagger api generated queue name: {q}')
-            res = asyncio.run(self.queue_interrogation(m, q, n, req.image,
-                              req.threshold), debug=True)
+            res = await self.queue_interrogation(m, q, n, req.image,
+                                                 req.threshold)
         else:
-            image = decode_base64_to_image(req.image)
-            interrogator = utils.interrogators[m]
-            res = {"tag": {}, "rating": {}}
-            with self.queue_lock:
-                res["rating"], tag = interrogator.interrogate(image)
-
-            for k, v in tag.items():
-                if v > req.threshold:
-                    res["tag"][k] = v
+            self.check_limits(m)
+            # concurrent single requests are batched as well
+            res = await self.interrogate(m, req.image, req.threshold)
 
         return models.TaggerInterrogateResponse(caption=res)
 
+    @staticmethod
+    def decode_base64(data: str) -> Image.Image:
+        """ decode a base64 image now, not in the batch it goes to """
+        image = decode_base64_to_image(data)
+        image.load()
+        return image
+
+    @staticmethod
+    def decode_bytes(data: bytes) -> Image.Image:
+        """ decode an uploaded image, raises on a broken image """
+        image = Image.open(BytesIO(data))
+        image.load()
+        return image
+
+    async def endpoint_interrogate_batch(
+        self,
+        model: str = Form(...),
+        threshold: float = Form(0.0),
+        # the webui pins a fastapi without Annotated parameters
+        images: List[UploadFile] = File(...),  # noqa: B008
+    ):
+        """ interrogate multipart uploaded images, results in upload order """
+        if model not in utils.interrogators:
+            raise HTTPException(404, 'Model not found')
+        self.check_limits(model, len(images))
+
+        loop = asyncio.get_running_loop()
+
+        async def interrogate_upload(upload: UploadFile):
+            self.model_pending[model] += 1
+            try:
+                data = await upload.read()
+                image = await loop.run_in_executor(None, self.decode_bytes,
+                                                   data)
+                # all uploads are queued at once, so they share batches
+                caption = await asyncio.wrap_future(
+                    self.batcher.submit(model, image, threshold))
+                return models.TaggerBatchResult(name=upload.filename or '',
+                                                caption=caption)
+            except Exception as err:  # pylint: disable=broad-except
+                return models.TaggerBatchResult(name=upload.filename or '',
+                                                error=repr(err))
+            finally:
+                self.model_pending[model] -= 1
+
+        results = await asyncio.gather(*map(interrogate_upload, images))
+        return models.TaggerInterrogateBatchResponse(results=results)
+
+    def start_preload(self) -> None:
+        """ load and warm up the configured interrogators in the background """
+        keys = utils.split_str(getattr(shared.opts, 'tagger_preload', ''))
+        keys += utils.split_str(
+            getattr(shared.cmd_opts, 'tagger_preload', None) or '')
+        for key in keys:
+            if key not in utils.interrogators:
+                print(f'WD14 tagger: cannot preload unknown {key}')
+            else:
+                self.preload[key] = 'queued'
+        if len(self.preload) > 0:
+            Thread(target=self.run_preload, daemon=True,
+                   name='tagger-preload').start()
+
+    def run_preload(self) -> None:
+        for key in list(self.preload.keys()):
+            self.preload[key] = 'loading'
+            try:
+                utils.interrogators[key].warm_up()
+                self.preload[key] = 'ready'
+            except Exception as err:  # pylint: disable=broad-except
+                print(f'WD14 tagger: preloading {key} failed: {repr(err)}')
+                self.preload[key] = 'error'
+
+    def endpoint_readiness(self):
+        """ whether the preloaded interrogators are ready, and the others """
+        status = {k: 'unloaded' if x.model is None else 'loaded'
+                  for k, x in utils.interrogators.items()}
+        # unless unloaded since, by the model manager
+        status.update((k, v) for k, v in self.preload.items()
+                      if v != 'ready' or status[k] == 'loaded')
+        return models.TaggerReadinessResponse(
+            ready=all(x != 'queued' and x != 'loading'
+                      for x in self.preload.values()),
+            models=status,
+        )
+
+    @staticmethod
+    def local_images(pattern: str) -> List[str]:
+        """ the files of a glob pattern, only below the webui data dir """
+        root = os.path.realpath(data_path)
+        pattern = os.path.join(root, pattern)
+        # the directory before any wildcard, checked before the search
+        fixed = os.path.dirname(re.split(r'[*?[]', pattern, maxsplit=1)[0])
+
+        def inside(path: str) -> bool:
+            return os.path.commonpath([root, os.path.realpath(path)]) == root
+
+        if not inside(fixed):
+            raise HTTPException(403, 'Images must be in the webui data '
+                                f'directory {root}')
+        # also not through links out of it
+        return sorted(x for x in glob(pattern, recursive=True)
+                      if os.path.isfile(x) and inside(x))
+
+    def endpoint_variant_report(self, req: models.TaggerVariantReportRequest):
+        """ accuracy and speed of an int8 or fp16 variant against its base """
+        variant = utils.interrogators.get(req.model)
+        if getattr(variant, 'variant', None) is None:
+            raise HTTPException(404, 'Model variant not found')
+        base = utils.interrogators.get(req.model.rsplit('.', 1)[0])
+        if base is None:
+            raise HTTPException(404, 'Base model not found')
+
+        paths = self.local_images(req.images)
+        try:
+            # the lock is taken per batch, queued interrogations go between
+            report = quantize.compare(base, variant, paths, req.threshold,
+                                      self.queue_lock)
+        except ValueError as err:
+            raise HTTPException(400, str(err)) from err
+        print(f'{req.model} vs {base.name}: {report}')
+        return report
+
     def endpoint_interrogators(self):
         return models.TaggerInterrogatorsResponse(
             models=list(utils.interrogators.keys())
@@ -219,12 +505,15 @@ class Api:
     def endpoint_unload_interrogators(self):
         unloaded_models = 0
 
-        for i in utils.interrogators.values():
-            if i.unload():
-                unloaded_models = unloaded_models + 1
+        # not while the batchers run inference
+        with self.queue_lock:
+            for i in utils.interrogators.values():
+                if i.unload():
+                    unloaded_models = unloaded_models + 1
 
         return f"Successfully unload {unloaded_models} model(s)"
 
 
 def on_app_started(_, app: FastAPI):
-    Api(app, queue_lock, '/tagger/v1')
+    api = Api(app, queue_lock, '/tagger/v1')
+    api.start_preload()
@@ -1,5 +1,5 @@
 """Purpose: Pydantic models for the API."""
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 from modules.api import models as sd_models  # pylint: disable=E0401
 from pydantic import BaseModel, Field
@@ -37,6 +37,63 @@ class TaggerInterrogateResponse(BaseModel):
     )
 
 
+class TaggerBatchResult(BaseModel):
+    """Result for one image of a batch request"""
+    name: str = Field(
+        title='Name',
+        description='The filename of the uploaded image.',
+    )
+    caption: Optional[Dict[str, Dict[str, float]]] = Field(
+        title='Caption',
+        description='The generated captions, if the image was interrogated.',
+        default=None,
+    )
+    error: Optional[str] = Field(
+        title='Error',
+        description='Why the image could not be interrogated.',
+        default=None,
+    )
+
+
+class TaggerInterrogateBatchResponse(BaseModel):
+    """Interrogate batch response model"""
+    results: List[TaggerBatchResult] = Field(
+        title='Results',
+        description='One result per uploaded image, in upload order.'
+    )
+
+
+class TaggerReadinessResponse(BaseModel):
+    """Readiness response model"""
+    ready: bool = Field(
+        title='Ready',
+        description='Whether all preloaded interrogators are ready.',
+    )
+    models: Dict[str, str] = Field(
+        title='Models',
+        description='Per interrogator: queued, loading, ready, error, '
+                    'loaded or unloaded.',
+    )
+
+
+class TaggerVariantReportRequest(BaseModel):
+    """Variant report request model"""
+    model: str = Field(
+        title='Model',
+        description='The variant interrogator, e.g. wd14-vit.v2.int8.',
+    )
+    images: str = Field(
+        title='Images',
+        description='Glob pattern of the images to compare on, relative '
+                    'to the webui data directory.',
+    )
+    threshold: float = Field(
+        title='Threshold',
+        description='The threshold for the tag agreement.',
+        default=0.35,
+    )
+
+
 class TaggerInterrogatorsResponse(BaseModel):
     """Interrogators response model"""
     models: List[str] = Field(
@@ -0,0 +1,90 @@
+""" Micro batching of API interrogations, per model """
+from collections import defaultdict, deque
+from concurrent.futures import Future
+from threading import Condition, Thread
+from time import monotonic
+from typing import Any, Callable, Deque, Dict, List, Tuple
+
+# (model, [(image, threshold), ...]) -> one result per image, or the
+# exception of that image
+ProcessTP = Callable[[str, List[Tuple[Any, float]]], List[Any]]
+
+
+class MicroBatcher:
+    """
+    collects the images queued for a model until max_batch images are
+    waiting, or the first one waited max_wait seconds. Then a worker thread
+    for that model processes them in one call and resolves the futures. If
+    the call fails, the images are processed again one at a time, so that
+    only the futures of the images that fail on their own fail.
+    """
+    def __init__(
+        self, process: ProcessTP, max_batch: Callable[[], int],
+        max_wait: Callable[[], float]
+    ) -> None:
+        self.process = process
+        # callables, so changed settings apply to the next batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.cond = Condition()
+        self.pending: Dict[str, Deque[Tuple[float, Any, float, Future]]] = \
+            defaultdict(deque)
+        self.workers: Dict[str, Thread] = {}
+
+    def submit(self, model: str, image: Any, threshold: float) -> Future:
+        """ queue an image, the future resolves to its result """
+        future = Future()
+        with self.cond:
+            self.pending[model].append((monotonic(), image, threshold,
+                                        future))
+            if model not in self.workers:
+                self.workers[model] = Thread(
+                    target=self.work, args=(model,), daemon=True,
+                    name=f'tagger-batcher-{model}')
+                self.workers[model].start()
+            self.cond.notify_all()
+        return future
+
+    def next_batch(self, model: str) -> List[Tuple[Any, float, Future]]:
+        """ wait for a full batch, or until the first image waited enough """
+        pending = self.pending[model]
+        with self.cond:
+            while len(pending) == 0:
+                self.cond.wait()
+            max_batch = max(int(self.max_batch()), 1)
+            deadline = pending[0][0] + max(float(self.max_wait()), 0.0)
+            while len(pending) < max_batch:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            batch = []
+            while len(pending) > 0 and len(batch) < max_batch:
+                _, image, threshold, future = pending.popleft()
+                # skip callers that went away
+                if future.set_running_or_notify_cancel():
+                    batch.append((image, threshold, future))
+            return batch
+
+    def work(self, model: str) -> None:
+        while True:
+            batch = self.next_batch(model)
+            if len(batch) > 0:
+                self.run(model, batch)
+
+    def run(self, model: str, batch: List[Tuple[Any, float, Future]]):
+        """ process a batch and resolve its futures """
+        try:
+            results = self.process(model, [x[:2] for x in batch])
+        except Exception as err:  # pylint: disable=broad-except
+            if len(batch) == 1:
+                batch[0][2].set_exception(err)
+                return
+            for item in batch:
+                self.run(model, [item])
+            return
+        for (_, _, future), result in zip(batch, results):
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -0,0 +1,194 @@
+""" Persistent cache of raw model outputs, keyed by image and model """
+import os
+import json
+from collections import OrderedDict
+from hashlib import blake2b
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Optional
+
+import numpy as np
+
+from modules import shared  # pylint: disable=import-error
+
+CACHE_DIR = Path(shared.models_path, 'interrogators', 'cache')
+
+# rows of a new cache, the files double in size up to the configured size
+INITIAL_ROWS = 1024
+
+# model file hashes, memoized on (size, mtime) of the model file
+model_hashes: Dict[str, list] = {}
+
+
+def file_hash(path: os.PathLike) -> str:
+    """ blake2b checksum of the file contents """
+    hasher = blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def model_hash(model_path: str) -> str:
+    """ hash of a model file, only recomputed when the file changed """
+    stat = os.stat(model_path)
+    index = CACHE_DIR.joinpath('models.json')
+    if len(model_hashes) == 0 and index.is_file():
+        try:
+            model_hashes.update(json.loads(index.read_text()))
+        except json.JSONDecodeError as err:
+            print(f'Ignoring {index}: {repr(err)}')
+
+    known = model_hashes.get(model_path)
+    if known is not None and known[:2] == [stat.st_size, stat.st_mtime]:
+        return known[2]
+
+    print(f'Hashing {model_path}')
+    checksum = file_hash(model_path)
+    model_hashes[model_path] = [stat.st_size, stat.st_mtime, checksum]
+    CACHE_DIR.mkdir(0o755, True, True)
+    index.write_text(json.dumps(model_hashes))
+    return checksum
+
+
+class ConfidenceCache:
+    """
+    Raw confidence vectors, one float16 row per image, in a memory mapped
+    matrix. Next to it the image hash and the last use of each row are
+    memory mapped, so only the rows that change are written. The files
+    double in size when full, up to limit rows; then the least recently used
+    row is evicted.
+    """
+    def __init__(self, stem: Path, width: int, limit: int) -> None:
+        self.stem = stem
+        self.width = width
+        self.limit = limit
+        self.lock = Lock()
+        meta = self.path('.json')
+
+        old_capacity = 0
+        if meta.is_file() and all(self.path(x).is_file() for x in
+                                  ['.f16', '.keys', '.ticks']):
+            info = json.loads(meta.read_text())
+            if info['width'] == width:
+                old_capacity = info['capacity']
+
+        capacity = min(max(old_capacity, INITIAL_ROWS), limit)
+        if old_capacity != capacity:
+            self.resize(old_capacity, capacity)
+        self.load(capacity)
+
+    def load(self, capacity: int) -> None:
+        """ map the files, with capacity rows """
+        self.capacity = capacity
+        self.data = np.memmap(self.path('.f16'), np.float16, 'r+',
+                              shape=(capacity, self.width))
+        self.keys = np.memmap(self.path('.keys'), 'S64', 'r+',
+                              shape=(capacity,))
+        self.ticks = np.memmap(self.path('.ticks'), np.int64, 'r+',
+                               shape=(capacity,))
+
+        # image hash -> row, ordered from least to most recently used
+        ticks = np.array(self.ticks)
+        used = np.flatnonzero(ticks)
+        used = used[np.argsort(ticks[used], kind='stable')]
+        self.rows = OrderedDict(zip((x.decode() for x in self.keys[used]),
+                                    used.tolist()))
+        self.free = np.flatnonzero(ticks == 0)
+        self.next_free = 0
+        self.tick = int(ticks.max(initial=0))
+
+    def path(self, ext: str) -> Path:
+        return Path(f'{self.stem}{ext}')
+
+    def resize(self, old_capacity: int, capacity: int) -> None:
+        """ (re)create the files, keeping the most recently used rows """
+        layout = {'.f16': (np.float16, (self.width,)), '.keys': ('S64', ()),
+                  '.ticks': (np.int64, ())}
+        old = {}
+        if old_capacity > 0:
+            for ext, (dtype, shape) in layout.items():
+                os.replace(self.path(ext), self.path(ext + '.old'))
+                old[ext] = np.memmap(self.path(ext + '.old'), dtype, 'r',
+                                     shape=(old_capacity,) + shape)
+            ticks = np.array(old['.ticks'])
+            kept = np.argsort(-ticks, kind='stable')[:capacity]
+            kept = kept[ticks[kept] > 0]
+
+        for ext, (dtype, shape) in layout.items():
+            new = np.memmap(self.path(ext), dtype, 'w+',
+                            shape=(capacity,) + shape)
+            if ext in old:
+                new[:len(kept)] = old[ext][kept]
+                del old[ext]
+                os.remove(self.path(ext + '.old'))
+            new.flush()
+            del new
+        self.path('.json').write_text(json.dumps({'width': self.width,
+                                                  'capacity': capacity}))
+
+    def grow(self) -> None:
+        """ double the rows, up to the limit; call with lock held """
+        capacity = min(2 * self.capacity, self.limit)
+        self.flush_maps()
+        # unmapped, so that the files can be replaced
+        del self.data, self.keys, self.ticks
+        self.resize(self.capacity, capacity)
+        self.load(capacity)
+
+    def get(self, image_hash: str) -> Optional[np.ndarray]:
+        """ the cached confidences of an image, or None """
+        with self.lock:
+            row = self.rows.get(image_hash)
+            if row is None:
+                return None
+            self.rows.move_to_end(image_hash)
+            self.tick += 1
+            self.ticks[row] = self.tick
+            return np.array(self.data[row], dtype=np.float32)
+
+    def put(self, image_hash: str, confidences: np.ndarray) -> None:
+        """ store the confidences of an image, evict if the cache is full """
+        with self.lock:
+            row = self.rows.pop(image_hash, None)
+            if row is None:
+                if self.next_free == len(self.free) and \
+                        self.capacity < self.limit:
+                    self.grow()
+                if self.next_free < len(self.free):
+                    row = int(self.free[self.next_free])
+                    self.next_free += 1
+                else:
+                    _, row = self.rows.popitem(last=False)
+            self.rows[image_hash] = row
+            self.tick += 1
+            self.data[row] = confidences
+            self.keys[row] = image_hash.encode()
+            self.ticks[row] = self.tick
+
+    def flush(self) -> None:
+        with self.lock:
+            self.flush_maps()
+
+    def flush_maps(self) -> None:
+        for mapped in (self.data, self.keys, self.ticks):
+            mapped.flush()
+
+
+def open_cache(
+    name: str, model_path: str, width: int
+) -> Optional[ConfidenceCache]:
+    """
+    open the cache for this interrogator and model file, if enabled. The
+    size setting is per model, its files grow up to it as images are added.
+    """
+    size_mb = int(getattr(shared.opts, 'tagger_cache_mb', 1024))
+    # a float16 row, plus the key and last use of the row
+    limit = (size_mb << 20) // (width * 2 + 72)
+    if limit < 1:
+        return None
+
+    key = f'{name}\t{model_hash(model_path)}'.encode()
+    CACHE_DIR.mkdir(0o755, True, True)
+    stem = CACHE_DIR.joinpath(blake2b(key, digest_size=16).hexdigest())
+    return ConfidenceCache(stem, width, limit)
@@ -0,0 +1,93 @@
+""" The tag filters of a query, compiled and memoized per configuration """
+from re import compile as re_comp, error as re_error, IGNORECASE
+from typing import Dict, List, Optional, Pattern, Set, Tuple
+
+from modules.deepbooru import re_special  # pylint: disable=import-error
+
+# group references only work within their own pattern, not merged
+re_backref = re_comp(r'\\[1-9]|\(\?P=')
+
+
+def merge(patterns: List[Pattern], named=False) -> Optional[Pattern]:
+    """ one alternation of the (^...$ compiled) patterns """
+    parts = []
+    for i, rex in enumerate(patterns):
+        parts.append(f'(?P<_f{i}>{rex.pattern})' if named
+                     else f'(?:{rex.pattern})')
+    try:
+        return re_comp('|'.join(parts), flags=IGNORECASE)
+    except re_error:
+        return None
+
+
+class TagFilter:
+    """
+    corrects tag names and tells whether they are excluded. The exclude
+    patterns are merged into one regex, the search patterns into one regex
+    that tells which replacement applies, and the result per raw tag name is
+    memoized until the configuration changes.
+    """
+    def __init__(
+        self, exclude: List[Pattern], search: Dict[int, Pattern],
+        replace: List[str], repl_us: bool, escape: bool, kamojis: Set[str]
+    ) -> None:
+        self.repl_us = repl_us
+        self.escape = escape
+        self.kamojis = kamojis
+        self.memo: Dict[str, Tuple[str, bool]] = {}
+
+        # patterns with group references are matched separately
+        merged = [x for x in exclude if not re_backref.search(x.pattern)]
+        self.exclude = [x for x in exclude if re_backref.search(x.pattern)]
+        if len(merged) > 0:
+            rex = merge(merged)
+            if rex is None:
+                self.exclude = exclude
+            else:
+                self.exclude.insert(0, rex)
+
+        self.search = []
+        self.replace = replace
+        self.dispatch = None
+        if len(search) > 0 and len(search) == len(replace):
+            self.search = [search[i] for i in range(len(search))]
+            if not any(re_backref.search(x.pattern) for x in self.search):
+                self.dispatch = merge(self.search, named=True)
+
+    def matches(self, repl_us: bool, escape: bool, kamojis: Set[str]) -> bool:
+        """ whether this filter was made for these settings """
+        return repl_us == self.repl_us and escape == self.escape and \
+            kamojis is self.kamojis
+
+    def search_replace(self, tag: str) -> str:
+        if self.dispatch is not None:
+            found = self.dispatch.match(tag)
+            if found is None:
+                return tag
+            # the group of the first pattern that matches closes last
+            i = int(found.lastgroup[2:])
+            return self.search[i].sub(self.replace[i], tag)
+        for i, regex in enumerate(self.search):
+            if regex.match(tag):
+                return regex.sub(self.replace[i], tag)
+        return tag
+
+    def __call__(self, raw: str) -> Tuple[str, bool]:
+        """ the corrected tag and whether it is excluded """
+        got = self.memo.get(raw)
+        if got is not None:
+            return got
+
+        tag = raw
+        if self.repl_us and tag not in self.kamojis:
+            tag = tag.replace('_', ' ')
+
+        if self.escape:
+            tag = re_special.sub(r'\\\1', tag)  # tag_escape_pattern
+
+        if len(self.search) > 0:
+            tag = self.search_replace(tag)
+
+        got = (tag, any(x.match(tag) for x in self.exclude))
+        self.memo[raw] = got
+        return got
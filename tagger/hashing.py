@@ -0,0 +1,116 @@
+""" Image hashes, the keys of the db and the cache of model outputs """
+import os
+import sqlite3
+from hashlib import blake2b, sha256
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+from modules import shared  # pylint: disable=import-error
+from tagger.cache import CACHE_DIR  # pylint: disable=import-error
+
+# pixels: sha256 of the decoded pixels, equal for re-encoded images
+# file: blake2b of the file contents, no decoding needed
+# file+stat: as file, but only rehashed if the (size, mtime, inode) changed
+HASH_MODES = ['pixels', 'file', 'file+stat']
+
+
+def pixel_hash(data: bytes) -> str:
+    """ sha256 of the pixels of an image """
+    return sha256(data).hexdigest()
+
+
+def file_hash(path: os.PathLike) -> str:
+    """ blake2b of the file, 64 hex digits as the sha256 of pixels """
+    hasher = blake2b(digest_size=32)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class StatIndex:
+    """
+    file hashes by path, valid as long as size, mtime and inode of the file
+    are unchanged. New hashes are kept in memory until flush.
+    """
+    def __init__(self, path: os.PathLike) -> None:
+        self.lock = Lock()
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT '
+                              'PRIMARY KEY, size INTEGER, mtime INTEGER, '
+                              'inode INTEGER, hash TEXT)')
+        self.new: Dict[str, Tuple[int, int, int, str]] = {}
+
+    def get(self, path: str, stat: os.stat_result) -> Optional[str]:
+        key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        with self.lock:
+            row = self.new.get(path)
+            if row is None:
+                row = self.conn.execute(
+                    'SELECT size, mtime, inode, hash FROM hashes WHERE path '
+                    '= ?', (path,)).fetchone()
+        if row is not None and tuple(row[:3]) == key:
+            return row[3]
+        return None
+
+    def put(self, path: str, stat: os.stat_result, checksum: str) -> None:
+        with self.lock:
+            self.new[path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino,
+                              checksum)
+
+    def flush(self) -> None:
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)',
+                ((k,) + v for k, v in self.new.items()))
+            self.new = {}
+
+
+stat_index: Optional[StatIndex] = None
+stat_index_lock = Lock()
+
+
+def get_stat_index() -> StatIndex:
+    global stat_index  # pylint: disable=global-statement
+    with stat_index_lock:
+        if stat_index is None:
+            CACHE_DIR.mkdir(0o755, True, True)
+            stat_index = StatIndex(CACHE_DIR.joinpath('file_hashes.sqlite'))
+    return stat_index
+
+
+def hash_mode() -> str:
+    mode = getattr(shared.opts, 'tagger_hash_mode', 'pixels')
+    return mode if mode in HASH_MODES else 'pixels'
+
+
+def path_hash(path: os.PathLike) -> Optional[str]:
+    """
+    hash of an image file without decoding it, or None in pixels mode or if
+    the file cannot be read.
+    """
+    mode = hash_mode()
+    if mode == 'pixels':
+        return None
+    try:
+        if mode == 'file':
+            return file_hash(path)
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        index = get_stat_index()
+        checksum = index.get(path, stat)
+        if checksum is None:
+            checksum = file_hash(path)
+            index.put(path, stat, checksum)
+        return checksum
+    except OSError as err:
+        print(f'{path}: {repr(err)}')
+        return None
+
+
+def flush() -> None:
+    """ write the new file hashes """
+    if stat_index is not None:
+        stat_index.flush()
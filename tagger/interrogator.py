@@ -4,12 +4,18 @@ from pathlib import Path
 import io
 import json
 import inspect
+from copy import copy
 from re import match as re_match
 from platform import system, uname
-from typing import Tuple, List, Dict, Callable
+from threading import Lock
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, List, Dict, Callable, Optional, NamedTuple
 from pandas import read_csv
 from PIL import Image, UnidentifiedImageError
-from numpy import asarray, float32, expand_dims, exp
+from collections import defaultdict
+from numpy import asarray, float16, float32, exp, stack, zeros, \
+    concatenate, flatnonzero
 from tqdm import tqdm
 from huggingface_hub import hf_hub_download
 
@@ -17,6 +23,11 @@ from modules.paths import extensions_dir
 from modules import shared
 from tagger import settings  # pylint: disable=import-error
 from tagger.uiset import QData, IOData  # pylint: disable=import-error
+from tagger.pipeline import prefetch  # pylint: disable=import-error
+from tagger import cache as tagger_cache  # pylint: disable=import-error
+from tagger import hashing  # pylint: disable=import-error
+from tagger import quantize  # pylint: disable=import-error
+from tagger.manager import manager  # pylint: disable=import-error
 from . import dbimutils  # pylint: disable=import-error # noqa
 
 Its = settings.InterrogatorSettings
@@ -27,20 +38,32 @@ use_cpu = ('all' in shared.cmd_opts.use_cpu) or (
 
 # https://onnxruntime.ai/docs/execution-providers/
 # https://github.com/toriato/stable-diffusion-webui-wd14-tagger/commit/e4ec460122cf674bbf984df30cdb10b4370c1224#r92654958
-onnxrt_providers = ['CUDAExecutionProvider', 'CPUExecutionProvider']
+# providers per onnx session; a session per device, or per core subset on cpu
+onnxrt_devices: List[list] = []
 
 if shared.cmd_opts.additional_device_ids is not None:
-    m = re_match(r'([cg])pu:\d+$', shared.cmd_opts.additional_device_ids)
-    if m is None:
-        raise ValueError('--device-id is not cpu:<nr> or gpu:<nr>')
-    if m.group(1) == 'c':
-        onnxrt_providers.pop(0)
-    TF_DEVICE_NAME = f'/{shared.cmd_opts.additional_device_ids}'
+    device_ids = [x.strip() for x in
+                  shared.cmd_opts.additional_device_ids.split(',')]
+    for device_id in device_ids:
+        m = re_match(r'([cg])pu:(\d+)$', device_id)
+        if m is None:
+            raise ValueError(f'--additional-device-ids: {device_id} is not '
+                             'cpu:<nr> or gpu:<nr>')
+        if m.group(1) == 'g':
+            onnxrt_devices.append([
+                ('CUDAExecutionProvider', {'device_id': int(m.group(2))}),
+                'CPUExecutionProvider'
+            ])
+        elif ['CPUExecutionProvider'] not in onnxrt_devices:
+            onnxrt_devices.append(['CPUExecutionProvider'])
+    # tensorflow (DeepDanbooru) uses the first device
+    TF_DEVICE_NAME = f'/{device_ids[0]}'
 elif use_cpu:
     TF_DEVICE_NAME = '/cpu:0'
-    onnxrt_providers.pop(0)
+    onnxrt_devices.append(['CPUExecutionProvider'])
 else:
     TF_DEVICE_NAME = '/gpu:0'
+    onnxrt_devices.append(['CUDAExecutionProvider', 'CPUExecutionProvider'])
 
 print(f'== WD14 tagger {TF_DEVICE_NAME}, {uname()} ==')
 
@@ -61,6 +84,7 @@ class Interrogator:
     }
     output = None
     odd_increment = 0
+    load_lock = Lock()
 
     @classmethod
     def flip(cls, key):
@@ -110,15 +134,12 @@ class Interrogator:
         self.name = name
         self.model = None
         self.tags = None
-        # run_mode 0 is dry run, 1 means run (alternating), 2 means disabled
-        self.run_mode = 0 if hasattr(self, "large_batch_interrogate") else 2
+        # persistent cache of raw confidences, if the interrogator has one
+        self.cache = None
 
     def load(self):
         raise NotImplementedError()
 
-    def large_batch_interrogate(self, images: List, dry_run=False) -> str:
-        raise NotImplementedError()
-
     def unload(self) -> bool:
         unloaded = False
 
@@ -147,7 +168,8 @@ class Interrogator:
         else:
             # single process
             count += 1
-            data = ('', '', fi_key) + self.interrogate(image)
+            data = ('', '', fi_key) + self.interrogate_cached(
+                image, sha, self.full_tags())
             # When drag-dropping an image, the path [0] is not known
             if Interrogator.input["unload_after"]:
                 self.unload()
@@ -159,21 +181,45 @@ class Interrogator:
 
         Interrogator.output = QData.finalize(count)
 
-    def batch_interrogate_image(self, index: int) -> None:
-        # if outputpath is '', no tags file will be written
-        if len(IOData.paths[index]) == 5:
-            path, out_path, output_dir, image_hash, image = IOData.paths[index]
-        elif len(IOData.paths[index]) == 4:
-            path, out_path, output_dir, image_hash = IOData.paths[index]
-            image = Interrogator.load_image(path)
-            # should work, we queried before to get the image_hash
+    def prepare_image(self, index: int) -> Tuple:
+        """ decode, hash and preprocess an image; runs in a worker thread """
+        entry = IOData.paths[index]
+        image = entry[4] if len(entry) == 5 else None
+        if len(entry) > 3:
+            image_hash = entry[3]
         else:
-            path, out_path, output_dir = IOData.paths[index]
-            image = Interrogator.load_image(path)
-            if image is None:
-                return
+            # unless hashing pixels, an image in the db is not decoded
+            image_hash = IOData.get_path_hash(entry[0])
+            if image_hash is None:
+                image = Interrogator.load_image(entry[0])
+                if image is None:
+                    return index, None, None, None, False
+                image_hash = IOData.get_bytes_hash(image.tobytes())
+
+        data = None
+        cached = False
+        if image_hash + self.name not in QData.query:
+            self.ensure_loaded()
+            if self.cache is not None:
+                data = self.cache.get(image_hash)
+                cached = data is not None
+            if not cached:
+                if image is None:
+                    image = Interrogator.load_image(entry[0])
+                    if image is None:
+                        return index, None, None, None, False
+                data = self.preprocess(image)
+        return index, image, image_hash, data, cached
+
+    def batch_interrogate_image(self, prepared: Tuple) -> Optional[Tuple]:
+        """ register a prepared image, returns the query if not in db """
+        index, image, image_hash, data, cached = prepared
+        if image_hash is None:
+            return None
 
-            image_hash = IOData.get_bytes_hash(image.tobytes())
+        # if outputpath is '', no tags file will be written
+        path, out_path, output_dir = IOData.paths[index][:3]
+        if len(IOData.paths[index]) == 3:
             IOData.paths[index].append(image_hash)
             if getattr(shared.opts, 'tagger_store_images', False):
                 IOData.paths[index].append(image)
@@ -192,35 +238,115 @@ class Interrogator:
             i = QData.get_index(fi_key, abspath)
             # this file was already queried and stored
             QData.in_db[i] = (abspath, out_path, '', {}, {})
+            return None
+        if cached:
+            if QData.raw is not None:
+                QData.raw.put(abspath, data)
+            # in the cache, from another directory or glob
+            self.batch_add_result((abspath, out_path, fi_key),
+                                  self.postprocess(data, self.full_tags()))
+            return None
+        return (abspath, out_path, fi_key, data, image_hash)
+
+    def batch_add_result(self, query: Tuple, result: Tuple) -> None:
+        """ add the interrogation of an image to the batch """
+        data = query + result
+        # also the tags can indicate that the image is a duplicate
+        no_floats = sorted(filter(lambda x: not isinstance(x[0], float),
+                                  data[3].items()), key=lambda x: x[0])
+        sorted_tags = ','.join(f'({k},{v:.1f})' for (k, v) in no_floats)
+        QData.image_dups[sorted_tags].add(query[0])
+        QData.apply_filters(data)
+        QData.had_new = True
+
+    def batch_interrogate_pending(self, pending: List[Tuple]) -> None:
+        """ run the pending, preprocessed images through the model at once """
+        inputs = [x[3] for x in pending]
+        full = self.full_tags()
+        if self.cache is None and QData.raw is None:
+            results = self.run_batch(inputs, full)
         else:
-            data = (abspath, out_path, fi_key) + self.interrogate(image)
-            # also the tags can indicate that the image is a duplicate
-            no_floats = sorted(filter(lambda x: not isinstance(x[0], float),
-                                      data[3].items()), key=lambda x: x[0])
-            sorted_tags = ','.join(f'({k},{v:.1f})' for (k, v) in no_floats)
-            QData.image_dups[sorted_tags].add(abspath)
-            QData.apply_filters(data)
-            QData.had_new = True
-
+            results = []
+            for query, raw in zip(pending, self.infer(inputs)):
+                if self.cache is not None:
+                    self.cache.put(query[4], raw)
+                if QData.raw is not None:
+                    QData.raw.put(query[0], raw)
+                results.append(self.postprocess(raw, full))
+
+        for query, result in zip(pending, results):
+            self.batch_add_result(query[:3], result)
+
+    @manager.in_use
     def batch_interrogate(self) -> None:
         """ Interrogate all images in the input list """
+        if QData.save_raw:
+            # the labels of the raw confidences are known once loaded
+            self.ensure_loaded()
+        with QData.outputs(self.name, getattr(self, 'label_names', None)):
+            self.batch_query()
+
+    def batch_raw_from_cache(self) -> None:
+        """ the raw confidences of the images that were in the db """
+        if QData.raw is None or self.cache is None:
+            return
+        for index in QData.raw.missing():
+            entry = IOData.paths[index]
+            raw = self.cache.get(entry[3]) if len(entry) > 3 else None
+            if raw is not None:
+                QData.raw.put(str(entry[0].absolute()), raw)
+
+    def batch_query(self) -> None:
+        """ the batch interrogation, with the outputs open """
         QData.clear(1 - Interrogator.input["cumulative"])
 
-        if Interrogator.input["large_query"] is True and self.run_mode < 2:
-            # TODO: write specified tags files instead of simple .txt
-            image_list = [str(x[0].resolve()) for x in IOData.paths]
-            self.large_batch_interrogate(image_list, self.run_mode == 0)
+        if Interrogator.input["large_query"] is True:
+            # the tags files are written as their batch is done
+            with QData.writing():
+                count = self.large_batch_interrogate()
+
+            if Interrogator.input["unload_after"]:
+                self.unload()
 
-            # alternating dry run and run modes
-            self.run_mode = (self.run_mode + 1) % 2
-            count = len(image_list)
             Interrogator.output = QData.finalize(count)
         else:
             verb = getattr(shared.opts, 'tagger_verbose', True)
             count = len(QData.query)
-
-            for i in tqdm(range(len(IOData.paths)), disable=verb, desc='Tags'):
-                self.batch_interrogate_image(i)
+            batch_size = max(int(getattr(shared.opts,
+                                         'tagger_infer_batch_size', 8)), 1)
+            workers = int(getattr(shared.opts, 'tagger_prefetch_workers', 2))
+            depth = int(getattr(shared.opts, 'tagger_prefetch_depth', 32))
+            pending = []
+
+            # images are decoded and preprocessed ahead in worker threads,
+            # while the model runs on the pending batch.
+            prepared = prefetch(self.prepare_image, range(len(IOData.paths)),
+                                workers, depth)
+            for item in tqdm(prepared, total=len(IOData.paths), disable=verb,
+                             desc='Tags'):
+                query = self.batch_interrogate_image(item)
+                if query is None:
+                    continue
+                if any(query[2] == x[2] for x in pending):
+                    # a duplicate within this batch: query the first one, so
+                    # that this one is retrieved from the db, as before.
+                    self.batch_interrogate_pending(pending)
+                    pending = []
+                    QData.in_db[QData.get_index(query[2], query[0])] = \
+                        (query[0], query[1], '', {}, {})
+                    continue
+                pending.append(query)
+                if len(pending) >= batch_size:
+                    self.batch_interrogate_pending(pending)
+                    pending = []
+
+            if len(pending) > 0:
+                self.batch_interrogate_pending(pending)
+
+            self.batch_raw_from_cache()
+            if self.cache is not None:
+                self.cache.flush()
+            hashing.flush()
 
             if Interrogator.input["unload_after"]:
                 self.unload()
@@ -228,9 +354,167 @@ class Interrogator:
             count = len(QData.query) - count
             Interrogator.output = QData.finalize_batch(count)
 
+    def prepare_large(self, index: int) -> Tuple:
+        """ decode and preprocess an image of a large query """
+        image = Interrogator.load_image(IOData.paths[index][0])
+        if image is None:
+            return index, None
+        return index, self.preprocess(image)
+
+    def large_batch_write(self, batch: List[Tuple]) -> None:
+        """ run a batch of a large query and write its tags files """
+        full = self.full_tags()
+        if QData.raw is None:
+            results = self.run_batch([x[1] for x in batch], full)
+        else:
+            results = []
+            raws = self.infer([x[1] for x in batch])
+            for (index, _), raw in zip(batch, raws):
+                QData.raw.put(str(IOData.paths[index][0].absolute()), raw)
+                results.append(self.postprocess(raw, full))
+        for (index, _), result in zip(batch, results):
+            path, out_path, output_dir = IOData.paths[index][:3]
+            if output_dir:
+                output_dir.mkdir(0o755, True, True)
+                IOData.paths[index][2] = ''
+
+            QData.apply_filters((str(path.absolute()), out_path, '') + result)
+            if out_path != '':
+                tags = QData.for_tags_file.pop(out_path)
+                for k in QData.add_tags:
+                    tags[k] = 1.0
+                QData.write_tags_file(out_path, tags)
+
+    def large_batch_interrogate(self) -> int:
+        """
+        Interrogate a large batch of images. The images are streamed through
+        the model and each tags file is written as soon as its batch is done.
+        Nothing is stored in the db, and the tag fraction threshold is not
+        applied to the tags files, since it requires the whole batch.
+        """
+        verb = getattr(shared.opts, 'tagger_verbose', True)
+        batch_size = max(int(getattr(shared.opts,
+                                     'tagger_infer_batch_size', 8)), 1)
+        workers = int(getattr(shared.opts, 'tagger_prefetch_workers', 2))
+        depth = int(getattr(shared.opts, 'tagger_prefetch_depth', 32))
+        count = 0
+        batch = []
+
+        prepared = prefetch(self.prepare_large, range(len(IOData.paths)),
+                            workers, depth)
+        for index, data in tqdm(prepared, total=len(IOData.paths),
+                                disable=verb, desc='Large query'):
+            if data is None:
+                continue
+            batch.append((index, data))
+            if len(batch) >= batch_size:
+                self.large_batch_write(batch)
+                count += len(batch)
+                batch = []
+
+        if len(batch) > 0:
+            self.large_batch_write(batch)
+            count += len(batch)
+        return count
+
+    def warm_up(self) -> None:
+        """ load, and run once so that the first query is not slower """
+        self.ensure_loaded()
+        self.interrogate(Image.new('RGB', (448, 448), 'white'))
+
+    def ensure_loaded(self) -> None:
+        """ load the model if not loaded yet, also from worker threads """
+        if self.model is None:
+            with Interrogator.load_lock:
+                if self.model is None:
+                    self.load()
+        manager.touch(self)
+
+    def footprint(self) -> int:
+        """ estimated memory use of the loaded model, in bytes """
+        return 0
+
+    def preprocess(self, image: Image):
+        """ convert an image to the model input, by default the image """
+        return image
+
+    def interrogate_cached(
+        self, image: Image, image_hash: str, full=False
+    ) -> Tuple[
+        Dict[str, float],  # rating confidences
+        Dict[str, float]  # tag confidences
+    ]:
+        """ interrogate an image, unless its confidences are cached """
+        self.ensure_loaded()
+        if self.cache is None:
+            return self.interrogate(image, full)
+
+        raw = self.cache.get(image_hash)
+        if raw is None:
+            raw = self.infer([self.preprocess(image)])[0]
+            self.cache.put(image_hash, raw)
+            self.cache.flush()
+        return self.postprocess(raw, full)
+
+    def set_vocabulary(self, names, rating_indices) -> None:
+        """ precompute the tag name arrays that postprocess indexes """
+        names = asarray(names, dtype=object)
+        is_rating = zeros(len(names), dtype=bool)
+        is_rating[rating_indices] = True
+        self.rating_indices = flatnonzero(is_rating)
+        self.tag_indices = flatnonzero(~is_rating)
+        self.rating_names = names[self.rating_indices].tolist()
+        # the columns of the raw confidences
+        self.label_names = names.tolist()
+        self.tag_names = names[self.tag_indices]
+
+    @staticmethod
+    def full_tags() -> bool:
+        """ whether the UI threshold is below the floor, so all tags """
+        floor = getattr(shared.opts, 'tagger_confidence_floor', 0.005)
+        return QData.threshold < floor
+
+    def postprocess(self, confidences, full=False) -> Tuple[
+        Dict[str, float],  # rating confidences
+        Dict[str, float]  # tag confidences
+    ]:
+        """
+        map the confidences of one image to the ratings and tags. Unless full
+        is set, only the tags with a confidence at or above the floor setting
+        are returned.
+        """
+        ratings = dict(zip(self.rating_names,
+                           confidences[self.rating_indices].tolist()))
+        confidences = confidences[self.tag_indices]
+        if full:
+            return ratings, dict(zip(self.tag_names.tolist(),
+                                     confidences.tolist()))
+
+        floor = getattr(shared.opts, 'tagger_confidence_floor', 0.005)
+        kept = flatnonzero(confidences >= floor)
+        return ratings, dict(zip(self.tag_names[kept].tolist(),
+                                 confidences[kept].tolist()))
+
+    def run_batch(self, inputs: List, full=False) -> List[Tuple[
+        Dict[str, float],  # rating confidences
+        Dict[str, float]  # tag confidences
+    ]]:
+        """ Interrogate preprocessed images, by default one at a time """
+        return [self.interrogate(x, full) for x in inputs]
+
+    def interrogate_batch(self, images: List[Image], full=False) -> List[
+        Tuple[
+            Dict[str, float],  # rating confidences
+            Dict[str, float]  # tag confidences
+        ]
+    ]:
+        """ Interrogate a list of images """
+        return self.run_batch([self.preprocess(x) for x in images], full)
+
     def interrogate(
         self,
-        image: Image
+        image: Image,
+        full=False
     ) -> Tuple[
         Dict[str, float],  # rating confidences
         Dict[str, float]  # tag confidences
@@ -292,7 +576,8 @@ class DeepDanbooruInterrogator(Interrogator):
 
     def interrogate(
         self,
-        image: Image
+        image: Image,
+        full=False
     ) -> Tuple[
         Dict[str, float],  # rating confidences
         Dict[str, float]  # tag confidences
@@ -329,9 +614,6 @@ class DeepDanbooruInterrogator(Interrogator):
 
         return ratings, tags
 
-    def large_batch_interrogate(self, images: List, dry_run=False) -> str:
-        raise NotImplementedError()
-
 
 # FIXME this is silly, in what scenario would the env change from MacOS to
 # another OS? TODO: remove if the author does not respond.
@@ -360,8 +642,337 @@ def get_onnxrt():
     return onnxruntime
 
 
-class WaifuDiffusionInterrogator(Interrogator):
+class SessionInfo(NamedTuple):
+    """ input and output metadata of an onnx model, resolved at load """
+    input_name: str
+    output_name: str
+    batch_size: int     # fixed batch size, or 0 if dynamic
+    height: int
+    width: int
+    layout: str         # 'NHWC' or 'NCHW'
+    dtype: type         # numpy dtype of the input
+    bgr: bool           # input channels in OpenCV BGR order, else RGB
+    scale: float        # pixel values are multiplied by this, e.g. 1/255
+    keep_ratio: bool    # resize the short edge, else pad to a square
+    sigmoid: bool       # apply a sigmoid to the output
+
+
+class OnnxInterrogator(Interrogator):
+    """ Interrogator for onnx models, the subclasses set the model family """
+    # defaults of the model family, for what the model does not tell
+    bgr = False
+    scale = 1.0
+    keep_ratio = False
+    sigmoid = False
+    size = 448
+    layout = 'NHWC'
+
+    def __init__(self, name: str) -> None:
+        super().__init__(name)
+        self.info = None
+        # all sessions, self.model is the first; idle ones are in the queue
+        self.sessions = []
+        self.idle = Queue()
+        self.pool = None
+        # 'int8' or 'fp16' to run a variant of the downloaded model
+        self.variant = None
+        # model file size times sessions, as memory estimate
+        self.mem_size = 0
+
+    def variant_of(self, kind: str) -> 'OnnxInterrogator':
+        """ an unloaded interrogator for a variant of this model """
+        other = copy(self)
+        OnnxInterrogator.__init__(other, f'{self.name} ({kind})')
+        other.variant = kind
+        return other
+
+    def download(self) -> Tuple[str, str]:
+        raise NotImplementedError()
+
+    @staticmethod
+    def cpu_groups(count: int) -> List[List[int]]:
+        """ split the usable cpu cores in count contiguous groups """
+        if hasattr(os, 'sched_getaffinity'):
+            cores = sorted(os.sched_getaffinity(0))
+        else:
+            cores = list(range(os.cpu_count() or 1))
+        count = max(min(count, len(cores)), 1)
+        size = len(cores) // count
+        return [cores[i * size:(i + 1) * size] for i in range(count)]
+
+    def session_config(self) -> Dict:
+        """ the session settings, with the overrides for this model """
+        config = {k: getattr(shared.opts, 'tagger_ort_' + k, v)
+                  for k, v in settings.SESSION_DEFAULTS.items()}
+        overrides = getattr(shared.opts, 'tagger_ort_model_options', '')
+        try:
+            overrides = json.loads(overrides or '{}').get(self.name, {})
+        except (json.JSONDecodeError, AttributeError) as err:
+            print(f'Ignoring onnx session overrides: {repr(err)}')
+            overrides = {}
+        for key, val in overrides.items():
+            if key in config:
+                config[key] = val
+            else:
+                print(f'{self.name}: unknown onnx session option "{key}"')
+        return config
+
+    @staticmethod
+    def session_options(ort, config: Dict):
+        """ SessionOptions from the session settings """
+        options = ort.SessionOptions()
+        if int(config['intra_threads']) > 0:
+            options.intra_op_num_threads = int(config['intra_threads'])
+        if int(config['inter_threads']) > 0:
+            options.inter_op_num_threads = int(config['inter_threads'])
+        options.graph_optimization_level = {
+            'disabled': ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+            'basic': ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+            'extended': ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+        }.get(config['opt_level'], ort.GraphOptimizationLevel.ORT_ENABLE_ALL)
+        if config['execution_mode'] == 'parallel':
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        else:
+            options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.enable_cpu_mem_arena = bool(config['cpu_mem_arena'])
+        options.enable_mem_pattern = bool(config['mem_pattern'])
+        return options
+
+    def create_session(
+        self, ort, config: Dict, path: str, optimized: Optional[str],
+        providers: List[str], cores: Optional[List[int]] = None, pin=False
+    ):
+        """ an InferenceSession, on the given cores if any """
+        options = self.session_options(ort, config)
+        if path == optimized:
+            # already optimized, only load
+            options.graph_optimization_level = \
+                ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        elif optimized is not None:
+            options.optimized_model_filepath = optimized
+        if cores is not None:
+            options.intra_op_num_threads = len(cores)
+            if pin and len(cores) > 1:
+                # the calling thread is the first, others are pinned
+                options.add_session_config_entry(
+                    'session.intra_op_thread_affinities',
+                    ';'.join(str(x + 1) for x in cores[1:]))
+        return ort.InferenceSession(path, sess_options=options,
+                                    providers=providers)
+
+    def create_sessions(self, model_path: str) -> list:
+        """ an InferenceSession per device, or per core group on cpu """
+        ort = get_onnxrt()
+        config = self.session_config()
+        count = int(getattr(shared.opts, 'tagger_cpu_sessions', 1))
+        pin = getattr(shared.opts, 'tagger_cpu_pinning', False)
+        sessions = []
+        for providers in onnxrt_devices:
+            is_cpu = providers == ['CPUExecutionProvider']
+            path, optimized = model_path, None
+            if config['save_optimized']:
+                # the optimized graph depends on the level and the provider
+                stem = os.path.splitext(model_path)[0]
+                device = 'cpu' if is_cpu else 'cuda'
+                optimized = f'{stem}.{config["opt_level"]}.{device}.ort.onnx'
+                if os.path.isfile(optimized) and os.path.getmtime(
+                        optimized) >= os.path.getmtime(model_path):
+                    path = optimized
+
+            if not is_cpu or count <= 1:
+                sessions.append(self.create_session(ort, config, path,
+                                                    optimized, providers))
+                continue
+            groups = self.cpu_groups(count)
+            sessions.append(self.create_session(
+                ort, config, path, optimized, providers, groups[0], pin))
+            if path != optimized and optimized is not None:
+                # written by the first session, the others load it
+                path = optimized
+            sessions += [self.create_session(
+                ort, config, path, optimized, providers, x, pin)
+                for x in groups[1:]]
+        return sessions
+
+    def load_tags(self, tags_path: str) -> None:
+        raise NotImplementedError()
+
+    def describe(self, model) -> SessionInfo:
+        """ resolve the metadata of the session once """
+        input_ = model.get_inputs()[0]
+        shape = input_.shape
+
+        # a dynamic dimension is a string (e.g. 'N') or None
+        def dim(val, default: int) -> int:
+            return val if isinstance(val, int) and val > 0 else default
+
+        if dim(shape[-1], 0) == 3:
+            layout = 'NHWC'
+        elif dim(shape[1], 0) == 3:
+            layout = 'NCHW'
+        else:
+            layout = self.layout
+        height, width = shape[1:3] if layout == 'NHWC' else shape[2:4]
+
+        return SessionInfo(
+            input_name=input_.name,
+            output_name=model.get_outputs()[0].name,
+            batch_size=dim(shape[0], 0),
+            height=dim(height, self.size),
+            width=dim(width, self.size),
+            layout=layout,
+            dtype=float16 if input_.type == 'tensor(float16)' else float32,
+            bgr=self.bgr,
+            scale=self.scale,
+            keep_ratio=self.keep_ratio,
+            sigmoid=self.sigmoid,
+        )
+
+    def load(self) -> None:
+        model_path, tags_path = self.download()
+        if self.variant is not None:
+            model_path = quantize.get_variant(model_path, self.variant)
+        self.load_tags(tags_path)
+        self.cache = tagger_cache.open_cache(
+            self.name, model_path,
+            len(self.rating_names) + len(self.tag_names))
+
+        self.sessions = self.create_sessions(model_path)
+        self.idle = Queue()
+        for session in self.sessions:
+            self.idle.put(session)
+        if len(self.sessions) > 1:
+            self.pool = ThreadPoolExecutor(len(self.sessions),
+                                           thread_name_prefix='tagger-onnx')
+        self.info = self.describe(self.sessions[0])
+        self.mem_size = os.path.getsize(model_path) * len(self.sessions)
+        # set last, worker threads wait in ensure_loaded until it's done
+        self.model = self.sessions[0]
+
+        print(f'Loaded {self.name} model from {model_path} in '
+              f'{len(self.sessions)} session(s)')
+
+    def footprint(self) -> int:
+        return self.mem_size
+
+    def unload(self) -> bool:
+        self.info = None
+        self.mem_size = 0
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        self.sessions = []
+        self.idle = Queue()
+        if self.cache is not None:
+            self.cache.flush()
+            self.cache = None
+        return super().unload()
+
+    def preprocess(self, image: Image):
+        """ convert an image to fit the model """
+        self.ensure_loaded()
+        info = self.info
+
+        # alpha to white
+        image = dbimutils.fill_transparent(image)
+        if info.keep_ratio:
+            image = dbimutils.resize(image, info.height)
+
+        image = asarray(image)
+        if info.bgr:
+            # PIL RGB to OpenCV BGR
+            image = image[:, :, ::-1]
+
+        if not info.keep_ratio:
+            image = dbimutils.make_square(image, info.height)
+            image = dbimutils.smart_resize(image, info.height)
+
+        image = image.astype(info.dtype)
+        if info.scale != 1.0:
+            image *= info.scale
+        if info.layout == 'NCHW':
+            # HWC -> CHW
+            image = image.transpose((2, 0, 1))
+        return image
+
+    def interrogate(
+        self,
+        image: Image,
+        full=False
+    ) -> Tuple[
+        Dict[str, float],  # rating confidences
+        Dict[str, float]  # tag confidences
+    ]:
+        return self.interrogate_batch([image], full)[0]
+
+    def run_batch(self, inputs: List, full=False) -> List[Tuple[
+        Dict[str, float],  # rating confidences
+        Dict[str, float]  # tag confidences
+    ]]:
+        return [self.postprocess(x, full) for x in self.infer(inputs)]
+
+    @manager.in_use
+    def infer(self, inputs: List) -> List:
+        """ the raw confidences for the preprocessed images, in order """
+        # init model
+        self.ensure_loaded()
+        info = self.info
+
+        if info.batch_size > 0:
+            size = info.batch_size
+        else:
+            size = max(int(getattr(shared.opts, 'tagger_infer_batch_size',
+                                   8)), 1)
+        results = [None] * len(inputs)
+
+        # if the aspect ratio is kept, only equally shaped images can stack
+        shapes = defaultdict(list)
+        for i, x in enumerate(inputs):
+            shapes[x.shape].append(i)
+
+        chunks = []
+        for indices in shapes.values():
+            step = size
+            if len(self.sessions) > 1 and info.batch_size == 0:
+                # spread the images over the sessions
+                step = min(size, -(-len(indices) // len(self.sessions)))
+            chunks += [indices[start:start + step]
+                       for start in range(0, len(indices), step)]
+
+        def run_chunk(chunk: List[int]) -> None:
+            batch = stack([inputs[i] for i in chunk])
+            if info.batch_size > 0 and len(chunk) < size:
+                # pad the last batch for a model with a fixed batch size
+                padding = zeros((size - len(chunk),) + batch.shape[1:],
+                                info.dtype)
+                batch = concatenate([batch, padding])
+
+            # evaluate model, on a session that is not busy
+            session = self.idle.get()
+            try:
+                confidences = session.run([info.output_name],
+                                          {info.input_name: batch})[0]
+            finally:
+                self.idle.put(session)
+            if info.sigmoid:
+                confidences = 1 / (1 + exp(-confidences))
+
+            for i, conf in zip(chunk, confidences):
+                results[i] = conf.flatten()
+
+        if self.pool is not None and len(chunks) > 1:
+            # list() to raise the exceptions of the chunks
+            list(self.pool.map(run_chunk, chunks))
+        else:
+            for chunk in chunks:
+                run_chunk(chunk)
+        return results
+
+
+class WaifuDiffusionInterrogator(OnnxInterrogator):
     """ Interrogator for Waifu Diffusion models """
+    bgr = True
+
     def __init__(
         self,
         name: str,
@@ -381,7 +992,7 @@ class WaifuDiffusionInterrogator(Interrogator):
         self.local_tags = None
         self.is_hf = is_hf
 
-    def download(self) -> None:
+    def download(self) -> Tuple[str, str]:
         mdir = Path(shared.models_path, 'interrogators')
         if self.is_hf:
             cache = getattr(shared.opts, 'tagger_hf_cache_dir', Its.hf_cache)
@@ -427,164 +1038,24 @@ class WaifuDiffusionInterrogator(Interrogator):
             json.dump(data, filename)
         return model_path, tags_path
 
-    def load(self) -> None:
-        model_path, tags_path = self.download()
-        ort = get_onnxrt()
-        self.model = ort.InferenceSession(model_path,
-                                          providers=onnxrt_providers)
-
-        print(f'Loaded {self.name} model from {self.repo_id}')
+    def load_tags(self, tags_path: str) -> None:
         self.tags = read_csv(tags_path)
-
-    def interrogate(
-        self,
-        image: Image
-    ) -> Tuple[
-        Dict[str, float],  # rating confidences
-        Dict[str, float]  # tag confidences
-    ]:
-        # init model
-        if self.model is None:
-            self.load()
-
-        # code for converting the image and running the model is taken from the
-        # link below. thanks, SmilingWolf!
-        # https://huggingface.co/spaces/SmilingWolf/wd-v1-4-tags/blob/main/app.py
-
-        # convert an image to fit the model
-        _, height, _, _ = self.model.get_inputs()[0].shape
-
-        # alpha to white
-        image = dbimutils.fill_transparent(image)
-
-        image = asarray(image)
-        # PIL RGB to OpenCV BGR
-        image = image[:, :, ::-1]
-
-        tags = dict
-
-        image = dbimutils.make_square(image, height)
-        image = dbimutils.smart_resize(image, height)
-        image = image.astype(float32)
-        image = expand_dims(image, 0)
-
-        # evaluate model
-        input_name = self.model.get_inputs()[0].name
-        label_name = self.model.get_outputs()[0].name
-        confidences = self.model.run([label_name], {input_name: image})[0]
-
-        tags = self.tags[:][['name']]
-        tags['confidences'] = confidences[0]
-
-        # first 4 items are for rating (general, sensitive, questionable,
-        # explicit)
-        ratings = dict(tags[:4].values)
-
-        # rest are regular tags
-        tags = dict(tags[4:].values)
-
-        return ratings, tags
-
-    def dry_run(self, images) -> Tuple[str, Callable[[str], None]]:
-
-        def process_images(filepaths, _):
-            lines = []
-            for image_path in filepaths:
-                image_path = image_path.numpy().decode("utf-8")
-                lines.append(f"{image_path}\n")
-            with io.open("dry_run_read.txt", "a", encoding="utf-8") as filen:
-                filen.writelines(lines)
-
-        scheduled = [f"{image_path}\n" for image_path in images]
-
-        # Truncate the file from previous runs
-        print("updating dry_run_read.txt")
-        io.open("dry_run_read.txt", "w", encoding="utf-8").close()
-        with io.open("dry_run_scheduled.txt", "w", encoding="utf-8") as filen:
-            filen.writelines(scheduled)
-        return process_images
-
-    def run(self, images, pred_model) -> Tuple[str, Callable[[str], None]]:
-        threshold = QData.threshold
-        self.tags["sanitized_name"] = self.tags["name"].map(
-            lambda i: i if i in Its.kaomojis else i.replace("_", " ")
-        )
-
-        def process_images(filepaths, images):
-            preds = pred_model(images).numpy()
-
-            for ipath, pred in zip(filepaths, preds):
-                ipath = ipath.numpy().decode("utf-8")
-
-                self.tags["preds"] = pred
-                generic = self.tags[self.tags["category"] == 0]
-                chosen = generic[generic["preds"] > threshold]
-                chosen = chosen.sort_values(by="preds", ascending=False)
-                tags_names = chosen["sanitized_name"]
-
-                key = ipath.split("/")[-1].split(".")[0] + "_" + self.name
-                QData.add_tags = tags_names
-                QData.apply_filters((ipath, '', {}, {}), key, False)
-
-                tags_string = ", ".join(tags_names)
-                txtfile = Path(ipath).with_suffix(".txt")
-                with io.open(txtfile, "w", encoding="utf-8") as filename:
-                    filename.write(tags_string)
-        return images, process_images
-
-    def large_batch_interrogate(self, images, dry_run=True) -> None:
-        """ Interrogate a large batch of images. """
-
-        # init model
-        if not hasattr(self, 'model') or self.model is None:
-            self.load()
-
-        os.environ["TF_XLA_FLAGS"] = '--tf_xla_auto_jit=2 '\
-                                     '--tf_xla_cpu_global_jit'
-        # Reduce logging
-        # os.environ["TF_CPP_MIN_LOG_LEVEL"] = "1"
-
-        import tensorflow as tf
-
-        from tagger.generator.tf_data_reader import DataGenerator
-
-        # tensorflow maps nearly all vram by default, so we limit this
-        # https://www.tensorflow.org/guide/gpu#limiting_gpu_memory_growth
-        # TODO: only run on the first run
-        gpus = tf.config.experimental.list_physical_devices("GPU")
-        if gpus:
-            for device in gpus:
-                try:
-                    tf.config.experimental.set_memory_growth(device, True)
-                except RuntimeError as err:
-                    print(err)
-
-        if dry_run:  # dry run
-            height, width = 224, 224
-            process_images = self.dry_run(images)
+        if 'category' in self.tags:
+            ratings = flatnonzero(self.tags['category'].to_numpy() == 9)
         else:
-            _, height, width, _ = self.model.inputs[0].shape
-
-            @tf.function
-            def pred_model(model):
-                return self.model(model, training=False)
-
-            process_images = self.run(images, pred_model)
+            # first 4 items are for rating (general, sensitive,
+            # questionable, explicit)
+            ratings = range(4)
+        self.set_vocabulary(self.tags['name'].to_numpy(), ratings)
 
-        generator = DataGenerator(
-            file_list=images, target_height=height, target_width=width,
-            batch_size=getattr(shared.opts, 'tagger_batch_size', 1024)
-        ).gen_ds()
 
-        orig_add_tags = QData.add_tags
-        for filepaths, image_list in tqdm(generator):
-            process_images(filepaths, image_list)
-        QData.add_tag = orig_add_tags
-        del os.environ["TF_XLA_FLAGS"]
-
-
-class MLDanbooruInterrogator(Interrogator):
+class MLDanbooruInterrogator(OnnxInterrogator):
     """ Interrogator for the MLDanbooru model. """
+    scale = 1 / 255
+    keep_ratio = True
+    sigmoid = True
+    layout = 'NCHW'
+
     def __init__(
         self,
         name: str,
@@ -615,46 +1086,7 @@ class MLDanbooruInterrogator(Interrogator):
         )
         return model_path, tags_path
 
-    def load(self) -> None:
-        model_path, tags_path = self.download()
-
-        ort = get_onnxrt()
-        self.model = ort.InferenceSession(model_path,
-                                          providers=onnxrt_providers)
-        print(f'Loaded {self.name} model from {model_path}')
-
+    def load_tags(self, tags_path: str) -> None:
         with open(tags_path, 'r', encoding='utf-8') as filen:
             self.tags = json.load(filen)
-
-    def interrogate(
-        self,
-        image: Image
-    ) -> Tuple[
-        Dict[str, float],  # rating confidents
-        Dict[str, float]  # tag confidents
-    ]:
-        # init model
-        if self.model is None:
-            self.load()
-
-        image = dbimutils.fill_transparent(image)
-        image = dbimutils.resize(image, 448)  # TODO CUSTOMIZE
-
-        x = asarray(image, dtype=float32) / 255
-        # HWC -> 1CHW
-        x = x.transpose((2, 0, 1))
-        x = expand_dims(x, 0)
-
-        input_ = self.model.get_inputs()[0]
-        output = self.model.get_outputs()[0]
-        # evaluate model
-        y, = self.model.run([output.name], {input_.name: x})
-
-        # Softmax
-        y = 1 / (1 + exp(-y))
-
-        tags = {tag: float(conf) for tag, conf in zip(self.tags, y.flatten())}
-        return {}, tags
-
-    def large_batch_interrogate(self, images: List, dry_run=False) -> str:
-        raise NotImplementedError()
+        self.set_vocabulary(self.tags, [])
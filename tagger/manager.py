@@ -0,0 +1,110 @@
+""" Unloads the least recently used interrogators, within a memory budget """
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, Thread
+from time import monotonic, sleep
+from typing import Dict
+
+from modules import shared  # pylint: disable=import-error
+
+
+class ModelManager:
+    """
+    keeps the recently used interrogators loaded. When the loaded models
+    exceed tagger_model_budget_mb, the least recently used ones are unloaded;
+    models unused for tagger_model_idle_timeout seconds are unloaded too.
+    A model is never unloaded while it is in use.
+    """
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.last_used: Dict[int, float] = {}
+        self.active: Dict[int, int] = defaultdict(int)
+        self.models: Dict[int, object] = {}
+        self.sweeper = None
+
+    @staticmethod
+    def budget() -> int:
+        mb = getattr(shared.opts, 'tagger_model_budget_mb', 0)
+        return max(int(mb), 0) << 20
+
+    @staticmethod
+    def idle_timeout() -> float:
+        return max(float(getattr(shared.opts, 'tagger_model_idle_timeout',
+                                 0)), 0.0)
+
+    def touch(self, interrogator) -> None:
+        """ mark an interrogator as used, unload others if over budget """
+        with self.lock:
+            key = id(interrogator)
+            self.models[key] = interrogator
+            self.last_used[key] = monotonic()
+            if self.sweeper is None:
+                self.sweeper = Thread(target=self.sweep, daemon=True,
+                                      name='tagger-model-manager')
+                self.sweeper.start()
+        if interrogator.model is not None:
+            self.fit_budget()
+
+    @contextmanager
+    def use(self, interrogator):
+        """ keep an interrogator loaded, once loaded, until done """
+        with self.lock:
+            self.active[id(interrogator)] += 1
+        try:
+            yield interrogator
+        finally:
+            with self.lock:
+                self.active[id(interrogator)] -= 1
+                self.last_used[id(interrogator)] = monotonic()
+
+    def in_use(self, method):
+        """ decorator for interrogator methods that run the model """
+        @wraps(method)
+        def wrapper(interrogator, *args, **kwargs):
+            with self.use(interrogator):
+                return method(interrogator, *args, **kwargs)
+        return wrapper
+
+    def unload(self, key: int) -> bool:
+        """ unload an interrogator unless in use; call with lock held """
+        if self.active[key] > 0:
+            return False
+        it = self.models[key]
+        # not while it is being loaded by another thread
+        with it.load_lock:
+            if it.model is None:
+                return False
+            return it.unload()
+
+    def fit_budget(self) -> None:
+        """ unload least recently used models, until they fit the budget """
+        budget = self.budget()
+        if budget == 0:
+            return
+        with self.lock:
+            loaded = [k for k, x in self.models.items() if x.model is not None]
+            total = sum(self.models[k].footprint() for k in loaded)
+            # the most recently used model stays, also if it alone is over
+            for key in sorted(loaded, key=self.last_used.get)[:-1]:
+                if total <= budget:
+                    break
+                size = self.models[key].footprint()
+                if self.unload(key):
+                    total -= size
+
+    def sweep(self) -> None:
+        while True:
+            timeout = self.idle_timeout()
+            sleep(min(max(timeout / 4, 1.0), 30.0) if timeout > 0 else 5.0)
+            if timeout == 0:
+                continue
+            now = monotonic()
+            with self.lock:
+                for key, it in self.models.items():
+                    if it.model is not None and \
+                            now - self.last_used[key] > timeout:
+                        self.unload(key)
+
+
+manager = ModelManager()
@@ -0,0 +1,38 @@
+""" Background decoding and preprocessing of images for batch queries """
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator
+
+
+def prefetch(
+    fun: Callable[[Any], Any],
+    items: Iterable,
+    workers: int = 2,
+    depth: int = 32,
+) -> Iterator:
+    """
+    yield fun(item) for all items, in order. The results are computed ahead
+    by a pool of worker threads, while the caller processes the previous
+    ones. At most depth results are in flight, so memory stays bounded.
+    """
+    if workers < 1:
+        # no workers: compute in the calling thread
+        for item in items:
+            yield fun(item)
+        return
+
+    depth = max(depth, workers)
+    with ThreadPoolExecutor(max_workers=workers,
+                            thread_name_prefix='tagger-prefetch') as pool:
+        window = deque()
+        try:
+            for item in items:
+                window.append(pool.submit(fun, item))
+                if len(window) >= depth:
+                    yield window.popleft().result()
+            while len(window) > 0:
+                yield window.popleft().result()
+        finally:
+            # when the consumer stops early, don't finish the prefetched work
+            for future in window:
+                future.cancel()
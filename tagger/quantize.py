@@ -0,0 +1,117 @@
+""" Dynamic int8 and float16 variants of onnx models """
+import os
+from contextlib import nullcontext
+from pathlib import Path
+from threading import Lock
+from time import perf_counter
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from modules import shared  # pylint: disable=import-error
+from tagger.cache import model_hash  # pylint: disable=import-error
+
+VARIANT_DIR = Path(shared.models_path, 'interrogators', 'quantized')
+VARIANTS = ['int8', 'fp16']
+
+
+def get_onnx():
+    try:
+        import onnx
+        return onnx
+    except ImportError:
+        from launch import run_pip  # pylint: disable=import-error
+        run_pip('install onnx', 'onnx')
+
+    import onnx
+    return onnx
+
+
+def get_variant(model_path: str, kind: str) -> str:
+    """ the path of the variant of a model, created on first use """
+    if kind not in VARIANTS:
+        raise ValueError(f'unknown model variant: {kind}')
+    VARIANT_DIR.mkdir(0o755, True, True)
+    path = VARIANT_DIR.joinpath(f'{model_hash(model_path)}.{kind}.onnx')
+    if path.is_file():
+        return str(path)
+
+    print(f'Creating {kind} variant of {model_path}')
+    tmp = path.with_suffix('.tmp')
+    onnx = get_onnx()
+    if kind == 'int8':
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(model_path, str(tmp), weight_type=QuantType.QUInt8)
+    else:
+        from onnxruntime.transformers.float16 import \
+            convert_float_to_float16
+        # float32 in and out, so preprocessing stays the same
+        model = convert_float_to_float16(onnx.load(model_path),
+                                         keep_io_types=True)
+        onnx.save(model, str(tmp))
+    os.replace(tmp, path)
+    return str(path)
+
+
+def compare(base, variant, paths: List[str], threshold: float,
+            lock: Optional[Lock] = None) -> Dict:
+    """
+    accuracy and speed of a variant, relative to the interrogator it was
+    made from, on the images in paths. The images are loaded and inferred
+    tagger_infer_batch_size at a time, the inference under lock.
+    """
+    from tagger.interrogator import Interrogator  # pylint: disable=E0401
+    size = max(int(getattr(shared.opts, 'tagger_infer_batch_size', 8)), 1)
+    lock = nullcontext() if lock is None else lock
+    count, seconds = 0, {'base': 0.0, 'variant': 0.0}
+    delta_sum, delta_max = 0.0, 0.0
+    kept_sum = {'base': 0, 'variant': 0}
+    both, jaccard = 0, 0.0
+    for start in range(0, len(paths), size):
+        images = [x for x in map(Interrogator.load_image,
+                                 paths[start:start + size]) if x]
+        if len(images) == 0:
+            continue
+        raw = {}
+        try:
+            for name, it in [('base', base), ('variant', variant)]:
+                inputs = [it.preprocess(x) for x in images]
+                with lock:
+                    begin = perf_counter()
+                    raw[name] = np.stack(it.infer(inputs))
+                    seconds[name] += perf_counter() - begin
+        finally:
+            for image in images:
+                image.close()
+        count += len(images)
+
+        delta = np.abs(raw['base'] - raw['variant'])
+        delta_sum += float(delta.sum(dtype=np.float64))
+        delta_max = max(delta_max, float(delta.max()))
+
+        # agreement of the tags above the threshold, ratings not included
+        tags = base.tag_indices
+        kept = {k: v[:, tags] > threshold for k, v in raw.items()}
+        same = (kept['base'] & kept['variant']).sum(axis=1)
+        union = (kept['base'] | kept['variant']).sum(axis=1)
+        for name, val in kept.items():
+            kept_sum[name] += int(val.sum())
+        both += int(same.sum())
+        jaccard += float(np.where(union > 0, same / np.maximum(union, 1),
+                                  1.0).sum())
+        width = delta.shape[1]
+
+    if count == 0:
+        raise ValueError('no images to compare with')
+
+    report = {'images': count}
+    for name, val in seconds.items():
+        report[f'{name}_seconds_per_image'] = val / count
+    report['mean_abs_delta'] = delta_sum / (count * width)
+    report['max_abs_delta'] = delta_max
+    report['base_tags'] = kept_sum['base']
+    report['variant_tags'] = kept_sum['variant']
+    report['tags_added'] = kept_sum['variant'] - both
+    report['tags_dropped'] = kept_sum['base'] - both
+    report['mean_jaccard'] = jaccard / count
+    return report
@@ -0,0 +1,151 @@
+""" Incremental scanning of the input directory for batch queries """
+import os
+import json
+from fnmatch import fnmatch
+from hashlib import blake2b
+from typing import Dict, List, NamedTuple, Set
+
+from tagger.cache import CACHE_DIR  # pylint: disable=import-error
+
+MANIFEST_DIR = CACHE_DIR.joinpath('scan')
+
+
+class ScanResult(NamedTuple):
+    paths: List[str]   # all files matching the glob pattern
+    added: Set[str]    # not in the previous scan
+    changed: Set[str]  # size or mtime changed since the previous scan
+    removed: Set[str]  # in the previous scan, but gone
+
+
+def match(parts: List[str], names: List[str], recursive: bool) -> bool:
+    """ match path components like glob, ** matches zero or more dirs """
+    if len(parts) == 0:
+        return len(names) == 0
+    if parts[0] == '**' and recursive:
+        for i in range(len(names) + 1):
+            if match(parts[1:], names[i:], recursive):
+                return True
+            if i < len(names) and names[i].startswith('.'):
+                # glob does not descend in hidden directories
+                return False
+        return False
+    if len(names) == 0:
+        return False
+    if names[0].startswith('.') and not parts[0].startswith('.'):
+        return False
+    return fnmatch(names[0], parts[0]) and \
+        match(parts[1:], names[1:], recursive)
+
+
+class Manifest:
+    """
+    per directory below the base directory: its mtime, files with size and
+    mtime, and subdirectories. A directory of which the mtime did not change
+    is not listed again, so a file rewritten in place with the same name is
+    only noticed if its directory changed too.
+    """
+    def __init__(self, base_dir: str) -> None:
+        # the returned paths start with base_dir as given, like glob
+        self.root = base_dir
+        self.base_dir = os.path.abspath(base_dir)
+        key = blake2b(self.base_dir.encode(), digest_size=16).hexdigest()
+        self.path = MANIFEST_DIR.joinpath(key + '.json')
+        # relative dir -> [dir mtime, {file: [size, mtime]}, [subdirs]]
+        self.dirs: Dict[str, list] = {}
+        if self.path.is_file():
+            try:
+                data = json.loads(self.path.read_text())
+                if data.get('base_dir') == self.base_dir:
+                    self.dirs = data['dirs']
+            except (json.JSONDecodeError, KeyError) as err:
+                print(f'Ignoring {self.path}: {repr(err)}')
+        self.dirty = False
+
+    def list_dir(self, rel: str) -> list:
+        """ the entry of a directory, listed again only if it changed """
+        path = os.path.join(self.base_dir, rel)
+        mtime = os.stat(path).st_mtime_ns
+        known = self.dirs.get(rel)
+        if known is not None and known[0] == mtime:
+            return known
+
+        files, subdirs = {}, []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        subdirs.append(entry.name)
+                    else:
+                        stat = entry.stat()
+                        files[entry.name] = [stat.st_size, stat.st_mtime_ns]
+                except OSError:
+                    # a broken symlink or a file removed while scanning
+                    continue
+        known = self.dirs[rel] = [mtime, files, sorted(subdirs)]
+        self.dirty = True
+        return known
+
+    def is_gone(self, rel: str, visited: Set[str]) -> bool:
+        """ whether a directory not visited no longer exists """
+        parent, name = os.path.split(rel)
+        if rel == '' or parent not in self.dirs:
+            return True
+        if parent in visited:
+            return name not in self.dirs[parent][2]
+        return self.is_gone(parent, visited)
+
+    def scan(self, parts: List[str], recursive: bool) -> ScanResult:
+        """ walk the directories that the glob pattern parts can match """
+        unlimited = recursive and '**' in parts
+        old = {os.path.join(rel, name): stamp
+               for rel, (_, files, _) in self.dirs.items()
+               for name, stamp in files.items()}
+        new = {}
+        visited = set()
+        stack = [('', 0)]
+        while len(stack) > 0:
+            rel, depth = stack.pop()
+            visited.add(rel)
+            try:
+                _, files, subdirs = self.list_dir(rel)
+            except OSError as err:
+                print(f'{os.path.join(self.base_dir, rel)}: {repr(err)}')
+                self.dirs.pop(rel, None)
+                continue
+            for name, stamp in files.items():
+                new[os.path.join(rel, name)] = stamp
+            if unlimited or depth + 1 < len(parts):
+                for name in subdirs:
+                    if not name.startswith('.'):
+                        stack.append((os.path.join(rel, name), depth + 1))
+
+        # forget directories that were removed
+        for rel in list(self.dirs.keys()):
+            if rel not in visited and self.is_gone(rel, visited):
+                del self.dirs[rel]
+                self.dirty = True
+
+        if self.dirty:
+            MANIFEST_DIR.mkdir(0o755, True, True)
+            self.path.write_text(json.dumps({'base_dir': self.base_dir,
+                                             'dirs': self.dirs}))
+            self.dirty = False
+
+        def full(rels) -> Set[str]:
+            return {os.path.join(self.root, x) for x in rels
+                    if match(parts, x.split(os.sep), recursive)}
+
+        paths = sorted(full(new.keys()))
+        return ScanResult(
+            paths=paths,
+            added=full(new.keys() - old.keys()),
+            changed=full(k for k in new.keys() & old.keys()
+                         if new[k] != old[k]),
+            removed=full(old.keys() - new.keys()),
+        )
+
+
+def scan(input_glob: str, base_dir: str, recursive: bool) -> ScanResult:
+    """ files matching input_glob below base_dir, with changes since """
+    rel = input_glob[len(base_dir):].lstrip(os.sep)
+    return Manifest(base_dir).scan(rel.split(os.sep), recursive)
@@ -12,6 +12,19 @@ DEFAULT_OFF = '[name].[output_extension]'
 HF_CACHE = os.environ.get('HF_HOME', os.environ.get('HUGGINGFACE_HUB_CACHE',
            str(os.path.join(shared.models_path, 'interrogators'))))
 
+# onnxruntime session settings, as tagger_ort_<key>. These keys are also used
+# for the per model overrides
+SESSION_DEFAULTS = {
+    'intra_threads': 0,
+    'inter_threads': 0,
+    'opt_level': 'all',
+    'execution_mode': 'sequential',
+    'cpu_mem_arena': True,
+    'mem_pattern': True,
+    'save_optimized': False,
+}
+
+
 def slider_wrapper(value, elem_id, **kwargs):
     # required or else gradio will throw errors
     return gr.Slider(**kwargs)
@@ -61,6 +74,17 @@ def on_ui_settings():
             section=section,
         ),
     )
+    shared.opts.add_option(
+        key='tagger_db_backend',
+        info=shared.OptionInfo(
+            'db.json',
+            label='Database format. db.sqlite only writes new interrogations '
+            'and imports an existing db.json the first time',
+            section=section,
+            component=gr.Radio,
+            component_args={"choices": ['db.json', 'db.sqlite']},
+        ),
+    )
     shared.opts.add_option(
         key='tagger_store_images',
         info=shared.OptionInfo(
@@ -114,11 +138,260 @@ def on_ui_settings():
         ),
     )
     shared.opts.add_option(
-        key='tagger_batch_size',
+        key='tagger_infer_batch_size',
+        info=shared.OptionInfo(
+            8,
+            label='Images per inference run in batch mode, large queries and '
+            'API queues (ignored for models with a fixed batch size)',
+            section=section,
+            component=slider_wrapper,
+            component_args={"minimum": 1, "maximum": 128, "step": 1},
+        ),
+    )
+    shared.opts.add_option(
+        key='tagger_cpu_sessions',
+        info=shared.OptionInfo(
+            1,
+            label='Onnx sessions per model on cpu, each with its own share of '
+            'the cores (reload the model to apply)',
+            section=section,
+            component=slider_wrapper,
+            component_args={"minimum": 1, "maximum": 64, "step": 1},
+        ),
+    )
+    shared.opts.add_option(
+        key='tagger_cpu_pinning',
+        info=shared.OptionInfo(
+            False,
+            label='Pin the threads of each cpu session to its cores',
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        key='tagger_model_budget_mb',
+        info=shared.OptionInfo(
+            0,
+            label='Memory budget of the loaded models in MB, least recently '
+            'used models are unloaded to stay within it (0 disables)',
+            section=section,
+            component=slider_wrapper,
+            component_args={"minimum": 0, "maximum": 65536, "step": 64},
+        ),
+    )
+    shared.opts.add_option(
+        key='tagger_model_idle_timeout',
+        info=shared.OptionInfo(
+            0,
+            label='Seconds after its last use before a model is unloaded '
+            '(0 disables)',
+            section=section,
+            component=slider_wrapper,
+            component_args={"minimum": 0, "maximum": 86400, "step": 60},
+        ),
+    )
+    shared.opts.add_option(
+        key='tagger_preload',
+        info=shared.OptionInfo(
+            '',
+            label='Interrogators to load and warm up at startup, comma '
+            'separated keys as listed by the API, e.g. wd14-vit.v2',
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        key='tagger_model_variants',
+        info=shared.OptionInfo(
+            '',
+            label='Also offer these variants of the onnx models, comma '
+            'separated: int8 (dynamic quantization) and/or fp16. Created on '
+            'first load; refresh the interrogators to apply',
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        key='tagger_ort_intra_threads',
+        info=shared.OptionInfo(
+            0,
+            label='Onnx threads within an operator (0: onnxruntime default)',
+            section=section,
+            component=slider_wrapper,
+            component_args={"minimum": 0, "maximum": 256, "step": 1},
+        ),
+    )
+    shared.opts.add_option(
+        key='tagger_ort_inter_threads',
+        info=shared.OptionInfo(
+            0,
+            label='Onnx threads between operators, for parallel execution '
+            '(0: onnxruntime default)',
+            section=section,
+            component=slider_wrapper,
+            component_args={"minimum": 0, "maximum": 256, "step": 1},
+        ),
+    )
+    shared.opts.add_option(
+        key='tagger_ort_opt_level',
+        info=shared.OptionInfo(
+            'all',
+            label='Onnx graph optimization level',
+            section=section,
+            component=gr.Radio,
+            component_args={"choices": ['disabled', 'basic', 'extended',
+                                        'all']},
+        ),
+    )
+    shared.opts.add_option(
+        key='tagger_ort_execution_mode',
+        info=shared.OptionInfo(
+            'sequential',
+            label='Onnx execution mode',
+            section=section,
+            component=gr.Radio,
+            component_args={"choices": ['sequential', 'parallel']},
+        ),
+    )
+    shared.opts.add_option(
+        key='tagger_ort_cpu_mem_arena',
+        info=shared.OptionInfo(
+            True,
+            label='Onnx cpu memory arena',
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        key='tagger_ort_mem_pattern',
+        info=shared.OptionInfo(
+            True,
+            label='Onnx memory pattern optimization',
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        key='tagger_ort_save_optimized',
+        info=shared.OptionInfo(
+            False,
+            label='Save the optimized onnx graph next to the model, and load '
+            'that on later loads',
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        key='tagger_ort_model_options',
+        info=shared.OptionInfo(
+            '',
+            label='Onnx session overrides per interrogator, as JSON, e.g. '
+            '{"WD14 ViT v2": {"intra_threads": 4, "opt_level": "extended"}}. '
+            'Keys: ' + ', '.join(SESSION_DEFAULTS.keys()),
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        key='tagger_api_batch_wait',
+        info=shared.OptionInfo(
+            10,
+            label='Milliseconds a queued API image waits for others to fill '
+            'an inference run',
+            section=section,
+            component=slider_wrapper,
+            component_args={"minimum": 0, "maximum": 1000, "step": 1},
+        ),
+    )
+    shared.opts.add_option(
+        key='tagger_api_queue_limit',
         info=shared.OptionInfo(
             1024,
-            label='batch size for large queries',
+            label='Maximum of images in an API queue, pending or with results '
+            'not retrieved; more get a 429 response (0 disables)',
+            section=section,
+            component=slider_wrapper,
+            component_args={"minimum": 0, "maximum": 65536, "step": 64},
+        ),
+    )
+    shared.opts.add_option(
+        key='tagger_api_model_limit',
+        info=shared.OptionInfo(
+            4096,
+            label='Maximum of API images pending per model; more get a 429 '
+            'response (0 disables)',
+            section=section,
+            component=slider_wrapper,
+            component_args={"minimum": 0, "maximum": 65536, "step": 64},
+        ),
+    )
+    shared.opts.add_option(
+        key='tagger_api_queue_ttl',
+        info=shared.OptionInfo(
+            3600,
+            label='Seconds after the last request before an API queue without '
+            'final request is dropped (0 disables)',
+            section=section,
+            component=slider_wrapper,
+            component_args={"minimum": 0, "maximum": 86400, "step": 60},
+        ),
+    )
+    shared.opts.add_option(
+        key='tagger_write_workers',
+        info=shared.OptionInfo(
+            4,
+            label='Threads that write the tags files of a batch',
+            section=section,
+            component=slider_wrapper,
+            component_args={"minimum": 1, "maximum": 32, "step": 1},
+        ),
+    )
+    shared.opts.add_option(
+        key='tagger_confidence_floor',
+        info=shared.OptionInfo(
+            0.005,
+            label='Drop tags below this confidence directly after inference',
+            section=section,
+            component=slider_wrapper,
+            component_args={"minimum": 0.0, "maximum": 0.1, "step": 0.001},
+        ),
+    )
+    shared.opts.add_option(
+        key='tagger_prefetch_workers',
+        info=shared.OptionInfo(
+            2,
+            label='Threads decoding and preprocessing images ahead of the '
+            'model in batch mode (0 disables)',
+            section=section,
+            component=slider_wrapper,
+            component_args={"minimum": 0, "maximum": 32, "step": 1},
+        ),
+    )
+    shared.opts.add_option(
+        key='tagger_prefetch_depth',
+        info=shared.OptionInfo(
+            32,
+            label='Maximum number of images decoded ahead in batch mode',
+            section=section,
+            component=slider_wrapper,
+            component_args={"minimum": 1, "maximum": 1024, "step": 1},
+        ),
+    )
+    shared.opts.add_option(
+        key='tagger_cache_mb',
+        info=shared.OptionInfo(
+            1024,
+            label='Size per model of the cache of model outputs, by image '
+            'content, in MB; its files grow up to it (0 disables)',
+            section=section,
+            component=slider_wrapper,
+            component_args={"minimum": 0, "maximum": 16384, "step": 64},
+        ),
+    )
+    shared.opts.add_option(
+        key='tagger_hash_mode',
+        info=shared.OptionInfo(
+            'pixels',
+            label='Identify images by: pixels (decodes every image, finds '
+            're-encoded duplicates), file (contents of the file) or file+stat '
+            '(file, rehashed only if size or mtime changed). Changing this '
+            'does not match earlier interrogations in the db',
             section=section,
+            component=gr.Radio,
+            component_args={"choices": ['pixels', 'file', 'file+stat']},
         ),
     )
     # see huggingface_hub guides/manage-cache
@@ -0,0 +1,189 @@
+""" Consolidated outputs of a batch, instead of a tags file per image """
+import os
+from json import dumps
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+# choices of the tags output, the first writes a tags file per image
+OUTPUTS = ['.txt files', 'JSONL', 'CSV', 'Parquet']
+
+
+def get_pyarrow():
+    try:
+        import pyarrow
+        return pyarrow
+    except ImportError:
+        from launch import run_pip  # pylint: disable=import-error
+        run_pip('install pyarrow', 'pyarrow')
+
+    import pyarrow
+    return pyarrow
+
+
+class Sink:
+    """
+    streams the rows of a batch to one file. Rows are buffered and written
+    rows_per_write at a time, to a temporary file that replaces the target
+    on close, or is deleted on abort.
+    """
+    ext = ''
+
+    def __init__(self, path: Path, rows_per_write=1024) -> None:
+        self.path = path.with_suffix(self.ext)
+        self.tmp = self.path.with_name(f'.{self.path.name}.tmp')
+        self.rows_per_write = rows_per_write
+        self.rows: List[Dict] = []
+        self.count = 0
+
+    def add(self, row: Dict) -> None:
+        self.rows.append(row)
+        if len(self.rows) >= self.rows_per_write:
+            self.flush()
+
+    def flush(self) -> None:
+        if len(self.rows) > 0:
+            self.write_rows(self.rows)
+            self.count += len(self.rows)
+            self.rows = []
+
+    def write_rows(self, rows: List[Dict]) -> None:
+        raise NotImplementedError()
+
+    def finish(self) -> None:
+        """ close the temporary file """
+
+    def close(self) -> None:
+        self.flush()
+        self.finish()
+        if self.tmp.exists():
+            os.replace(self.tmp, self.path)
+        print(f'Wrote {self.count} rows to {self.path}')
+
+    def abort(self) -> None:
+        """ close and delete the temporary file, keep a previous output """
+        self.rows = []
+        self.finish()
+        self.tmp.unlink(missing_ok=True)
+        print(f'Discarded the unfinished {self.path}')
+
+    @staticmethod
+    def frame(rows: List[Dict]) -> pd.DataFrame:
+        """ the rows with the weights and ratings as json """
+        frame = pd.DataFrame(rows)
+        for key in ['weights', 'ratings']:
+            frame[key] = frame[key].map(dumps)
+        return frame
+
+
+class JsonlSink(Sink):
+    """ a json object per line """
+    ext = '.jsonl'
+
+    def __init__(self, path: Path, rows_per_write=1024) -> None:
+        super().__init__(path, rows_per_write)
+        # pylint: disable=consider-using-with
+        self.file = open(self.tmp, 'w', encoding='utf-8')
+
+    def write_rows(self, rows: List[Dict]) -> None:
+        self.file.writelines(dumps(row) + '\n' for row in rows)
+
+    def finish(self) -> None:
+        self.file.close()
+
+
+class CsvSink(Sink):
+    """ a line per image, the weights and ratings as json """
+    ext = '.csv'
+
+    def __init__(self, path: Path, rows_per_write=1024) -> None:
+        super().__init__(path, rows_per_write)
+        # pylint: disable=consider-using-with
+        self.file = open(self.tmp, 'w', encoding='utf-8', newline='')
+
+    def write_rows(self, rows: List[Dict]) -> None:
+        self.frame(rows).to_csv(self.file, header=self.count == 0,
+                                index=False)
+
+    def finish(self) -> None:
+        self.file.close()
+
+
+class ParquetSink(Sink):
+    """ a row group per write, the weights and ratings as json """
+    ext = '.parquet'
+
+    def __init__(self, path: Path, rows_per_write=1024) -> None:
+        super().__init__(path, rows_per_write)
+        self.writer = None
+
+    def write_rows(self, rows: List[Dict]) -> None:
+        pa = get_pyarrow()
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(self.frame(rows), preserve_index=False)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(str(self.tmp), table.schema)
+        self.writer.write_table(table)
+
+    def finish(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+
+
+SINKS = {'JSONL': JsonlSink, 'CSV': CsvSink, 'Parquet': ParquetSink}
+
+
+def open_sink(kind: str, path: Path) -> Optional[Sink]:
+    """ the sink for an output choice, None for tags files """
+    if kind not in SINKS:
+        return None
+    return SINKS[kind](path)
+
+
+class RawVectors:
+    """
+    the raw confidences of a batch in a memory mapped .npy, one row per input
+    image, a column per label of the model. Rows of images without raw
+    confidences stay NaN. The labels and paths are written to a .json
+    with the same name.
+    """
+    def __init__(self, path: Path, paths: List[str], labels: List[str]):
+        self.path = path.with_suffix('.npy')
+        self.tmp = self.path.with_name(f'.{self.path.name}.tmp')
+        self.paths = paths
+        self.labels = labels
+        self.rows = {x: i for i, x in enumerate(paths)}
+        self.array = np.lib.format.open_memmap(
+            self.tmp, mode='w+', dtype=np.float32,
+            shape=(len(paths), len(labels)))
+        # filled rows are tracked, the others are set to NaN on close only
+        self.filled = np.zeros(len(paths), dtype=bool)
+
+    def put(self, path: str, raw) -> None:
+        row = self.rows.get(path)
+        if row is not None:
+            self.array[row] = raw
+            self.filled[row] = True
+
+    def missing(self) -> List[int]:
+        """ the rows that have no raw confidences yet """
+        return np.flatnonzero(~self.filled).tolist()
+
+    def close(self) -> None:
+        for row in self.missing():
+            self.array[row] = np.nan
+        self.array.flush()
+        del self.array
+        os.replace(self.tmp, self.path)
+        self.path.with_suffix('.json').write_text(dumps({
+            'labels': self.labels, 'paths': self.paths}), encoding='utf-8')
+        print(f'Wrote raw confidences of {int(self.filled.sum())}/'
+              f'{len(self.paths)} images to {self.path}')
+
+    def abort(self) -> None:
+        """ close and delete the temporary file, keep a previous output """
+        del self.array
+        self.tmp.unlink(missing_ok=True)
+        print(f'Discarded the unfinished {self.path}')
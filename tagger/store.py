@@ -0,0 +1,242 @@
+""" Storage of the interrogation results: db.json or db.sqlite """
+import sqlite3
+from collections import defaultdict
+from json import dumps, loads
+from math import ceil
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from jsonschema import validate
+
+SCHEMA = Path(__file__).parent.parent.joinpath('json_schema',
+                                               'db_json_v1_schema.json')
+
+# per index: rating and tag confidences
+Weights = Tuple[Dict[str, float], Dict[str, float]]
+
+
+def get_i_wt(stored: float) -> Tuple[int, float]:
+    """
+    in db.json, the weights & increment in the list are encoded. Each
+    filestamp-interrogation corresponds to an incrementing index. The index
+    is above the floating point, the weight is below.
+    """
+    i = ceil(stored) - 1
+    return i, stored - i
+
+
+def read_v1(path: Path) -> dict:
+    """ read and validate a db.json, raises ValidationError """
+    data = loads(path.read_text())
+    validate(data, loads(SCHEMA.read_text()))
+    return data
+
+
+class JsonStore:
+    """
+    results kept in memory, the whole db.json is rewritten on write. Next to
+    the db.json lists, per index the label ids and weights are kept, so the
+    results of one interrogation are found without a scan of all lists.
+    """
+    def __init__(self, path: Optional[Path] = None) -> None:
+        self.path = path
+        self.query: Dict[str, Tuple[str, int]] = {}
+        self.weighed = (defaultdict(list), defaultdict(list))
+        # label id -> (0 for rating or 1 for tag, name), and reverse
+        self.labels: List[Tuple[int, str]] = []
+        self.label_ids: Dict[Tuple[int, str], int] = {}
+        # index -> label ids, weights
+        self.rows: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+
+    def label_id(self, label: Tuple[int, str]) -> int:
+        lid = self.label_ids.get(label)
+        if lid is None:
+            lid = self.label_ids[label] = len(self.labels)
+            self.labels.append(label)
+        return lid
+
+    def import_v1(self, data: dict) -> None:
+        self.query = data["query"]
+        self.weighed = (defaultdict(list, data["rating"]),
+                        defaultdict(list, data["tag"]))
+
+        # invert the lists, once
+        rows = defaultdict(lambda: ([], []))
+        for j in range(2):
+            for ent, lst in self.weighed[j].items():
+                lid = self.label_id((j, ent))
+                for i, val in map(get_i_wt, lst):
+                    rows[i][0].append(lid)
+                    rows[i][1].append(val)
+        self.rows = {i: (np.array(ids, dtype=np.int32),
+                         np.array(wts, dtype=np.float64))
+                     for i, (ids, wts) in rows.items()}
+
+    def export_v1(self) -> dict:
+        return {
+            "rating": self.weighed[0],
+            "tag": self.weighed[1],
+            "query": self.query,
+        }
+
+    def add(self, fi_key: str, path: str, index: int,
+            weights: Weights) -> None:
+        """ store a new interrogation """
+        ids, wts = [], []
+        for j in range(2):
+            for ent, val in weights[j].items():
+                self.weighed[j][ent].append(val + index)
+                ids.append(self.label_id((j, ent)))
+                wts.append(val)
+        self.rows[index] = (np.array(ids, dtype=np.int32),
+                            np.array(wts, dtype=np.float64))
+        self.query[fi_key] = (path, index)
+
+    def set_path(self, fi_key: str, path: str) -> None:
+        self.query[fi_key] = (path, self.query[fi_key][1])
+
+    def next_index(self) -> int:
+        """ the index of the next new interrogation """
+        return len(self.query)
+
+    def get(self, indices: Iterable[int]) -> Dict[int, Weights]:
+        """ ratings and tags per index """
+        ret = {i: ({}, {}) for i in indices}
+        for i, got in ret.items():
+            if i not in self.rows:
+                continue
+            ids, wts = self.rows[i]
+            for lid, val in zip(ids.tolist(), wts.tolist()):
+                j, ent = self.labels[lid]
+                got[j][ent] = val
+        return ret
+
+    def write(self) -> None:
+        if self.path is not None:
+            self.path.write_text(dumps(self.export_v1(), indent=2))
+
+
+class SQLiteStore:
+    """
+    results in an sqlite database. Only the query index is read on opening,
+    the weights are read per interrogation when needed. A write only adds
+    the new interrogations and path changes.
+    """
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.lock = Lock()
+        self.is_new = not path.is_file()
+        # gradio may call from different threads, hence the lock
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS query (fi_key TEXT '
+                              'PRIMARY KEY, path TEXT NOT NULL, idx INTEGER '
+                              'NOT NULL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS weight (idx INTEGER '
+                              'NOT NULL, kind INTEGER NOT NULL, name TEXT NOT '
+                              'NULL, weight REAL NOT NULL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS weight_idx ON '
+                              'weight (idx)')
+            self.query = {k: (p, i) for k, p, i in self.conn.execute(
+                'SELECT fi_key, path, idx FROM query')}
+            last = self.conn.execute('SELECT MAX(idx) FROM weight').fetchone()
+        # indices are not reused, also not of replaced interrogations
+        self.end = max([i for _, i in self.query.values()] +
+                       [-1 if last[0] is None else last[0]], default=-1) + 1
+        self.new_queries: Dict[str, Tuple[str, int]] = {}
+        # index -> weights, not yet written
+        self.new_weights: Dict[int, Weights] = {}
+        # indices of replaced interrogations, their weights are deleted
+        self.stale: List[int] = []
+
+    def import_v1(self, data: dict) -> None:
+        """
+        add the interrogations of a db.json. Its indices follow those in use,
+        an interrogation of the same fi_key is replaced.
+        """
+        offset = self.end
+        for fi_key, (path, index) in data["query"].items():
+            self.replace(fi_key, (path, index + offset))
+        for j, kind in enumerate(["rating", "tag"]):
+            for ent, lst in data[kind].items():
+                for i, val in map(get_i_wt, lst):
+                    self.new_weights.setdefault(i + offset,
+                                                ({}, {}))[j][ent] = val
+                    self.end = max(self.end, i + offset + 1)
+        self.write()
+
+    def replace(self, fi_key: str, query: Tuple[str, int]) -> None:
+        """ set the query of fi_key, its former weights become stale """
+        old = self.query.get(fi_key)
+        if old is not None and old[1] != query[1]:
+            self.stale.append(old[1])
+            self.new_weights.pop(old[1], None)
+        self.query[fi_key] = query
+        self.new_queries[fi_key] = query
+        self.end = max(self.end, query[1] + 1)
+
+    def export_v1(self) -> dict:
+        weighed = (defaultdict(list), defaultdict(list))
+        with self.lock:
+            for i, j, ent, val in self.conn.execute(
+                    'SELECT idx, kind, name, weight FROM weight ORDER BY idx'):
+                weighed[j][ent].append(val + i)
+        return {
+            "rating": weighed[0],
+            "tag": weighed[1],
+            "query": self.query,
+        }
+
+    def add(self, fi_key: str, path: str, index: int,
+            weights: Weights) -> None:
+        """ store a new interrogation, written on the next write """
+        self.replace(fi_key, (path, index))
+        self.new_weights[index] = weights
+
+    def set_path(self, fi_key: str, path: str) -> None:
+        self.query[fi_key] = (path, self.query[fi_key][1])
+        self.new_queries[fi_key] = self.query[fi_key]
+
+    def next_index(self) -> int:
+        """ the index of the next new interrogation """
+        return self.end
+
+    def get(self, indices: Iterable[int]) -> Dict[int, Weights]:
+        """ ratings and tags per index """
+        ret = {i: ({}, {}) for i in indices}
+        keys = list(ret.keys())
+        with self.lock:
+            # stay below the sqlite limit of host parameters
+            for start in range(0, len(keys), 500):
+                part = keys[start:start + 500]
+                rows = self.conn.execute(
+                    'SELECT idx, kind, name, weight FROM weight WHERE idx IN '
+                    f'({",".join("?" * len(part))})', part)
+                for i, j, ent, val in rows:
+                    ret[i][j][ent] = val
+        # not yet written
+        for i, got in ret.items():
+            if i in self.new_weights:
+                for j in range(2):
+                    got[j].update(self.new_weights[i][j])
+        return ret
+
+    def write(self) -> None:
+        with self.lock, self.conn:
+            self.conn.executemany('DELETE FROM weight WHERE idx = ?',
+                                  ((i,) for i in self.stale))
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO query (fi_key, path, idx) VALUES '
+                '(?, ?, ?)', ((k, p, i) for k, (p, i) in
+                              self.new_queries.items()))
+            self.conn.executemany(
+                'INSERT INTO weight (idx, kind, name, weight) VALUES '
+                '(?, ?, ?, ?)', ((i, j, ent, val) for i, weights in
+                                 self.new_weights.items() for j in range(2)
+                                 for ent, val in weights[j].items()))
+        self.new_queries = {}
+        self.new_weights = {}
+        self.stale = []
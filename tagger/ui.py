@@ -3,12 +3,6 @@ from typing import Dict, Tuple, List, Optional
 import gradio as gr
 import re
 from PIL import Image
-from packaging import version
-
-try:
-    from tensorflow import __version__ as tf_version
-except ImportError:
-    tf_version = '0.0.0'
 
 from html import escape as html_esc
 
@@ -20,6 +14,7 @@ try:
 except ImportError:
     from webui import wrap_gradio_gpu_call  # pylint: disable=import-error
 from tagger import utils  # pylint: disable=import-error
+from tagger import sinks  # pylint: disable=import-error
 from tagger.interrogator import Interrogator as It  # pylint: disable=E0401
 from tagger.uiset import IOData, QData  # pylint: disable=import-error
 
@@ -216,11 +211,9 @@ def on_ui_tabs():
                             with gr.Column(variant='panel'):
                                 large_query = utils.preset.component(
                                     gr.Checkbox,
-                                    label='huge batch query (TF 2.10, '
-                                    'experimental)',
-                                    value=False,
-                                    interactive=version.parse(tf_version) ==
-                                    version.parse('2.10')
+                                    label='Large batch query (stream tags '
+                                    'files, no db)',
+                                    value=False
                                 )
                             with gr.Column(variant='panel'):
                                 save_tags = utils.preset.component(
@@ -228,6 +221,21 @@ def on_ui_tabs():
                                     label='Save to tags files',
                                     value=True
                                 )
+                        with gr.Row(variant='compact'):
+                            with gr.Column(variant='panel'):
+                                tags_output = utils.preset.component(
+                                    gr.Radio,
+                                    label='Tags output, one manifest in the '
+                                    'output directory instead of tags files',
+                                    choices=sinks.OUTPUTS,
+                                    value=sinks.OUTPUTS[0]
+                                )
+                            with gr.Column(variant='panel'):
+                                save_raw = utils.preset.component(
+                                    gr.Checkbox,
+                                    label='Save raw confidences (raw.npy)',
+                                    value=False
+                                )
 
                 info = gr.HTML(
                     label='Info',
@@ -411,6 +419,10 @@ def on_ui_tabs():
         unload_after.input(fn=It.flip('unload_after'), inputs=[], outputs=[])
 
         save_tags.input(fn=IOData.flip_save_tags(), inputs=[], outputs=[])
+        tags_output.change(fn=QData.set('output_format'),
+                           inputs=[tags_output], outputs=[])
+        save_raw.change(fn=QData.set('save_raw'), inputs=[save_raw],
+                        outputs=[])
 
         # Preset and unload buttons
         selected_preset.change(fn=utils.preset.apply, inputs=[selected_preset],
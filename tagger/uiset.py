@@ -3,20 +3,26 @@
 from typing import List, Dict, Tuple, Callable, Set, Optional
 import os
 from pathlib import Path
-from glob import glob
-from math import ceil
-from hashlib import sha256
-from re import compile as re_comp, sub as re_sub, match as re_match, IGNORECASE
-from json import dumps, loads
-from jsonschema import validate, ValidationError
+from re import compile as re_comp, IGNORECASE
+from json import JSONDecodeError
+from sqlite3 import Error as SQLiteError
+from jsonschema import ValidationError
 from functools import partial
+from contextlib import contextmanager
 from collections import defaultdict
 from PIL import Image
+import numpy as np
 
 from modules import shared  # pylint: disable=import-error
-from modules.deepbooru import re_special  # pylint: disable=import-error
 from tagger import format as tags_format  # pylint: disable=import-error
 from tagger import settings  # pylint: disable=import-error
+from tagger import hashing  # pylint: disable=import-error
+from tagger.scan import scan  # pylint: disable=import-error
+from tagger.filters import TagFilter  # pylint: disable=import-error
+from tagger.vocab import Vocabulary, TagStats, TagsFiles  # pylint: disable=import-error # noqa: E501
+from tagger.store import JsonStore, SQLiteStore, read_v1  # pylint: disable=import-error # noqa: E501
+from tagger.writer import TagsWriter, write_atomic  # pylint: disable=import-error # noqa: E501
+from tagger.sinks import RawVectors, open_sink  # pylint: disable=import-error # noqa: E501
 
 Its = settings.InterrogatorSettings
 
@@ -38,7 +44,7 @@ ItRetTP = Tuple[
 
 class IOData:
     """ data class for input and output paths """
-    last_path_mtimes = None
+    last_input_glob = None
     base_dir = None
     output_root = None
     paths: List[List[str]] = []
@@ -72,9 +78,14 @@ class IOData:
 
     @staticmethod
     def get_bytes_hash(data) -> str:
-        """ get sha256 checksum of file """
+        """ get sha256 checksum of the pixels """
         # Note: the checksum from an image is not the same as from file
-        return sha256(data).hexdigest()
+        return hashing.pixel_hash(data)
+
+    @staticmethod
+    def get_path_hash(path) -> Optional[str]:
+        """ get checksum of the file, None if hashing the pixels """
+        return hashing.path_hash(path)
 
     @classmethod
     def get_hashes(cls) -> Set[str]:
@@ -85,8 +96,10 @@ class IOData:
                 ret.add(entries[3])
             else:
                 # if there is no checksum, calculate it
-                image = Image.open(entries[0])
-                checksum = cls.get_bytes_hash(image.tobytes())
+                checksum = cls.get_path_hash(entries[0])
+                if checksum is None:
+                    image = Image.open(entries[0])
+                    checksum = cls.get_bytes_hash(image.tobytes())
                 entries.append(checksum)
                 ret.add(checksum)
         return ret
@@ -96,8 +109,6 @@ class IOData:
         """ update input glob pattern, and set input and output paths """
         input_glob = input_glob.strip()
 
-        paths = []
-
         # if there is no glob pattern, insert it automatically
         if not input_glob.endswith('*'):
             if not input_glob.endswith(os.sep):
@@ -114,23 +125,37 @@ class IOData:
         cls.err.discard(msg)
 
         recursive = getattr(shared.opts, 'tagger_batch_recursive', True)
-        path_mtimes = []
-        for filename in glob(input_glob, recursive=recursive):
-            if not os.path.isdir(filename):
-                ext = os.path.splitext(filename)[1].lower()
-                if ext in supported_extensions:
-                    path_mtimes.append(os.path.getmtime(filename))
-                    paths.append(filename)
-                elif ext != '.txt' and 'db.json' not in filename:
-                    print(f'{filename}: not an image extension: "{ext}"')
-
-        # interrogating in a directory with no pics, still flush the cache
-        if len(path_mtimes) > 0 and cls.last_path_mtimes == path_mtimes:
-            print('No changed images')
+        found = scan(input_glob, base_dir, recursive)
+        for filename in sorted(found.added):
+            ext = os.path.splitext(filename)[1].lower()
+            if ext not in supported_extensions and ext != '.txt' and \
+               'db.json' not in filename and 'db.sqlite' not in filename:
+                print(f'{filename}: not an image extension: "{ext}"')
+
+        def is_image(filename: str) -> bool:
+            ext = os.path.splitext(filename)[1].lower()
+            return ext in supported_extensions
+
+        paths = list(filter(is_image, found.paths))
+        changed = set(filter(is_image, found.added | found.changed))
+        removed = set(filter(is_image, found.removed))
+
+        if input_glob == cls.last_input_glob:
+            # interrogating in a directory with no pics, still flush the cache
+            if len(paths) > 0 and len(changed) + len(removed) == 0:
+                print('No changed images')
+                return
+
+            # same input: keep the unchanged entries, with their checksums
+            print(f'found {len(changed)} new or changed and {len(removed)} '
+                  f'removed image(s), of {len(paths)}')
+            kept = set(paths) - changed
+            keep = {str(x[0]): x for x in cls.paths if str(x[0]) in kept}
+            cls.set_batch_io(paths, keep)
             return
 
         QData.clear(2)
-        cls.last_path_mtimes = path_mtimes
+        cls.last_input_glob = input_glob
 
         if not cls.output_root:
             cls.output_root = Path(base_dir)
@@ -141,17 +166,22 @@ class IOData:
         cls.base_dir_last = Path(base_dir).parts[-1]
         cls.base_dir = base_dir
 
-        QData.read_json(cls.output_root)
+        QData.read_db(cls.output_root)
 
         print(f'found {len(paths)} image(s)')
         cls.set_batch_io(paths)
 
     @classmethod
-    def set_batch_io(cls, paths: List[str]) -> None:
+    def set_batch_io(
+        cls, paths: List[str], keep: Optional[Dict[str, list]] = None
+    ) -> None:
         """ set input and output paths for batch mode """
         checked_dirs = set()
         cls.paths = []
         for path in paths:
+            if keep and path in keep:
+                cls.paths.append(keep[path])
+                continue
             path = Path(path)
             if not cls.save_tags:
                 cls.paths.append([path, '', ''])
@@ -201,21 +231,34 @@ class QData:
     exclude_tags = []
     search_tags = {}
     replace_tags = []
+    # the above compiled, rebuilt when changed
+    tag_filter = None
     threshold = 0.35
     tag_frac_threshold = 0.05
     count_threshold = getattr(shared.opts, 'tagger_count_threshold', 100)
 
-    # read from db.json, update with what should be written to db.json:
-    json_db = None
-    weighed = (defaultdict(list), defaultdict(list))
-    query = {}
+    # db.json or db.sqlite, query is the fi_key -> (path, index) of the store
+    store = JsonStore()
+    query = store.query
 
-    # representing the (cumulative) current interrogations
+    # representing the (cumulative) current interrogations; the tags by id
+    vocab = Vocabulary()
     ratings = defaultdict(float)
-    tags = defaultdict(list)
-    discarded_tags = defaultdict(list)
+    tags = TagStats(vocab)
+    discarded_tags = TagStats(vocab)
     in_db = {}
-    for_tags_file = defaultdict(lambda: defaultdict(float))
+    for_tags_file = TagsFiles(vocab)
+    # while set, tags files are written in its worker threads
+    writer = None
+    # a manifest instead of tags files, see sinks.OUTPUTS, and raw vectors
+    output_format = '.txt files'
+    save_raw = False
+    sink = None
+    raw = None
+    # per tags file of the batch: its IOData.paths entry, ratings
+    sink_entries = {}
+    sink_ratings = {}
+    sink_model = ''
 
     had_new = False
     err = set()
@@ -244,15 +287,14 @@ class QData:
             cls.in_db.clear()
             cls.image_dups.clear()
         if mode > 1:
-            cls.json_db = None
-            cls.weighed = (defaultdict(list), defaultdict(list))
-            cls.query = {}
+            cls.set_store(JsonStore())
         if mode > 2:
             cls.add_tags = []
             cls.keep_tags = set()
             cls.exclude_tags = []
             cls.search_tags = {}
             cls.replace_tags = []
+            cls.tag_filter = None
 
     @classmethod
     def test_add(cls, tag: str, current: str, incompatible: list) -> None:
@@ -334,6 +376,7 @@ class QData:
     @classmethod
     def update_exclude(cls, exclude: str) -> None:
         cls.exclude_tags = []
+        cls.tag_filter = None
         if exclude == '':
             return
         un_re = re_comp(r' exclude(?: and \w+)? tags')
@@ -345,6 +388,7 @@ class QData:
     @classmethod
     def update_search(cls, search_str: str) -> None:
         cls.search_tags = {}
+        cls.tag_filter = None
         if search_str == '':
             return
         un_re = re_comp(r' search(?: and \w+)? tags')
@@ -362,6 +406,7 @@ class QData:
     @classmethod
     def update_replace(cls, replace: str) -> None:
         cls.replace_tags = []
+        cls.tag_filter = None
         if replace == '':
             return
         un_re = re_comp(r' replace(?: and \w+)? tags')
@@ -375,63 +420,73 @@ class QData:
             cls.err.discard(msg)
 
     @classmethod
-    def get_i_wt(cls, stored: int) -> Tuple[int, float]:
-        """
-        in db.json or QData.weighed, the weights & increment in the list are
-        encoded. Each filestamp-interrogation corresponds to an incrementing
-        index. The index is above the floating point, the weight is below.
-        """
-        i = ceil(stored) - 1
-        return i, stored - i
+    def set_store(cls, store) -> None:
+        cls.store = store
+        cls.query = store.query
 
     @classmethod
-    def read_json(cls, outdir) -> None:
-        """ read db.json if it exists, validate it, and update cls """
-        cls.json_db = None
-        if getattr(shared.opts, 'tagger_auto_serde_json', True):
-            cls.json_db = outdir.joinpath('db.json')
-            if cls.json_db.is_file():
-                print(f'Reading {cls.json_db}')
-                cls.had_new = False
-                msg = f'Error reading {cls.json_db}'
-                cls.err.discard(msg)
-                # validate json using either json_schema/db_jon_v1_schema.json
-                # or json_schema/db_jon_v2_schema.json
+    def read_db(cls, outdir) -> None:
+        """ open db.json or db.sqlite if configured, and update cls """
+        cls.set_store(JsonStore())
+        if not getattr(shared.opts, 'tagger_auto_serde_json', True):
+            return
+        backend = getattr(shared.opts, 'tagger_db_backend', 'db.json')
+        json_db = outdir.joinpath('db.json')
+        cls.had_new = False
 
-                schema = Path(__file__).parent.parent.joinpath(
-                    'json_schema', 'db_json_v1_schema.json'
-                )
+        if backend == 'db.sqlite':
+            sqlite_db = outdir.joinpath('db.sqlite')
+            msg = f'Error reading {sqlite_db}'
+            cls.err.discard(msg)
+            try:
+                store = SQLiteStore(sqlite_db)
+            except SQLiteError as err:
+                print(f'{msg}: {repr(err)}')
+                cls.err.add(msg)
+                return
+            cls.set_store(store)
+            if store.is_new and json_db.is_file():
+                # migrate the existing db.json, which is left in place
+                print(f'Importing {json_db} in {sqlite_db}')
+                msg = f'Error reading {json_db}'
+                cls.err.discard(msg)
                 try:
-                    data = loads(cls.json_db.read_text())
-                    validate(data, loads(schema.read_text()))
-
-                    # convert v2 back to v1
-                    if "meta" in data:
-                        cls.had_new = True  # <- force write for v2 -> v1
-                except (ValidationError, IndexError) as err:
+                    store.import_v1(read_v1(json_db))
+                except (ValidationError, JSONDecodeError, IndexError) as err:
                     print(f'{msg}: {repr(err)}')
                     cls.err.add(msg)
-                    data = {"query": {}, "tag": [], "rating": []}
+            print(f'Read {sqlite_db}: {len(cls.query)} interrogations.')
+            return
 
-                cls.query = data["query"]
-                cls.weighed = (
-                    defaultdict(list, data["rating"]),
-                    defaultdict(list, data["tag"])
-                )
-                print(f'Read {cls.json_db}: {len(cls.query)} interrogations, '
-                      f'{len(cls.tags)} tags.')
+        store = JsonStore(json_db)
+        cls.set_store(store)
+        if json_db.is_file():
+            print(f'Reading {json_db}')
+            msg = f'Error reading {json_db}'
+            cls.err.discard(msg)
+            try:
+                data = read_v1(json_db)
+
+                # convert v2 back to v1
+                if "meta" in data:
+                    cls.had_new = True  # <- force write for v2 -> v1
+                    del data["meta"]
+            except (ValidationError, JSONDecodeError, IndexError) as err:
+                print(f'{msg}: {repr(err)}')
+                cls.err.add(msg)
+                data = {"query": {}, "tag": {}, "rating": {}}
+
+            store.import_v1(data)
+            cls.set_store(store)
+            print(f'Read {json_db}: {len(cls.query)} interrogations, '
+                  f'{len(cls.tags)} tags.')
 
     @classmethod
-    def write_json(cls) -> None:
-        """ write db.json """
-        if cls.json_db is not None:
-            data = {
-                "rating": cls.weighed[0],
-                "tag": cls.weighed[1],
-                "query": cls.query,
-            }
-            cls.json_db.write_text(dumps(data, indent=2))
-            print(f'Wrote {cls.json_db}: {len(cls.query)} interrogations, '
+    def write_db(cls) -> None:
+        """ write db.json, or the new interrogations to db.sqlite """
+        if cls.store.path is not None:
+            cls.store.write()
+            print(f'Wrote {cls.store.path}: {len(cls.query)} interrogations, '
                   f'{len(cls.tags)} tags.')
 
     @classmethod
@@ -442,7 +497,7 @@ class QData:
                 print(f'Dup or rename: Identical checksums for {path}\n'
                       f'and: {cls.query[fi_key][0]} (path updated)')
                 cls.had_new = True
-            cls.query[fi_key] = (path, cls.query[fi_key][1])
+            cls.store.set_path(fi_key, path)
 
         return cls.query[fi_key][1]
 
@@ -450,58 +505,59 @@ class QData:
     def single_data(cls, fi_key: str) -> None:
         """ get tags and ratings for filestamp-interrogator """
         index = cls.query.get(fi_key)[1]
-        data = ({}, {})
-        for j in range(2):
-            for ent, lst in cls.weighed[j].items():
-                for i, val in map(cls.get_i_wt, lst):
-                    if i == index:
-                        data[j][ent] = val
-
+        data = cls.store.get([index])[index]
         QData.in_db[index] = ('', '', '') + data
 
+    @classmethod
+    def get_tag_filter(cls) -> TagFilter:
+        """ the compiled filters, for the current settings """
+        repl_us = getattr(shared.opts, 'tagger_repl_us', True)
+        escape = getattr(shared.opts, 'tagger_escape', False)
+        if cls.tag_filter is None or \
+           not cls.tag_filter.matches(repl_us, escape, Its.kamojis):
+            cls.tag_filter = TagFilter(cls.exclude_tags, cls.search_tags,
+                                       cls.replace_tags, repl_us, escape,
+                                       Its.kamojis)
+        return cls.tag_filter
+
     @classmethod
     def is_excluded(cls, ent: str) -> bool:
         """ check if tag is excluded """
-        return any(re_match(x, ent) for x in cls.exclude_tags)
+        return any(x.match(ent) for x in cls.get_tag_filter().exclude)
 
     @classmethod
     def correct_tag(cls, tag: str) -> str:
         """ correct tag for display """
-        replace_underscore = getattr(shared.opts, 'tagger_repl_us', True)
-        if replace_underscore and tag not in Its.kamojis:
-            tag = tag.replace('_', ' ')
-
-        if getattr(shared.opts, 'tagger_escape', False):
-            tag = re_special.sub(r'\\\1', tag)  # tag_escape_pattern
-
-        if len(cls.search_tags) == len(cls.replace_tags):
-            for i, regex in cls.search_tags.items():
-                if re_match(regex, tag):
-                    tag = re_sub(regex, cls.replace_tags[i], tag)
-                    break
-
-        return tag
+        return cls.get_tag_filter()(tag)[0]
 
     @classmethod
     def apply_filters(cls, data) -> None:
-        """ apply filters to query data, store in db.json if required """
+        """ apply filters to query data, store in the db if required """
         # data = (path, fi_key, tags, ratings, new)
         # fi_key == '' means this is a new file or interrogation for that file
 
         tags = sorted(data[4].items(), key=lambda x: x[1], reverse=True)
 
         fi_key = data[2]
-        index = len(cls.query)
+        index = cls.store.next_index()
+        # what is stored in the db, for a new interrogation
+        weights = ({}, {})
 
         ratings = sorted(data[3].items(), key=lambda x: x[1], reverse=True)
         # loop over ratings
         for rating, val in ratings:
             if fi_key != '':
-                cls.weighed[0][rating].append(val + index)
+                weights[0][rating] = val
             cls.ratings[rating] += val
 
         max_ct = cls.count_threshold - len(cls.add_tags)
+        tag_filter = cls.get_tag_filter()
         count = 0
+        # the kept and discarded tag ids and values, added at once
+        kept_ids, kept_vals = [], []
+        lost_ids, lost_vals = [], []
+        file_ids, file_vals = [], []
+        n_lost, new_lost = len(cls.discarded_tags), set()
         # loop over tags with db update
         for tag, val in tags:
             if isinstance(tag, float):
@@ -510,46 +566,56 @@ class QData:
                 continue
 
             if fi_key != '' and val >= 0.005:
-                cls.weighed[1][tag].append(val + index)
+                weights[1][tag] = val
 
             if count < max_ct:
-                tag = cls.correct_tag(tag)
+                tag, excluded = tag_filter(tag)
                 if tag not in cls.keep_tags:
-                    if cls.is_excluded(tag) or val < cls.threshold:
-                        if tag not in cls.add_tags and \
-                           len(cls.discarded_tags) < max_ct:
-                            cls.discarded_tags[tag].append(val)
+                    if excluded or val < cls.threshold:
+                        if tag not in cls.add_tags and n_lost < max_ct:
+                            tag_id = cls.vocab.id(tag)
+                            if tag_id not in cls.discarded_tags and \
+                               tag_id not in new_lost:
+                                new_lost.add(tag_id)
+                                n_lost += 1
+                            lost_ids.append(tag_id)
+                            lost_vals.append(val)
                         continue
                 if data[1] != '':
-                    current = cls.for_tags_file[data[1]].get(tag, 0.0)
-                    cls.for_tags_file[data[1]][tag] = min(val + current, 1.0)
+                    file_ids.append(cls.vocab.id(tag))
+                    file_vals.append(val)
                 count += 1
                 if tag not in cls.add_tags:
                     # those are already added
-                    cls.tags[tag].append(val)
+                    kept_ids.append(cls.vocab.id(tag))
+                    kept_vals.append(val)
             elif fi_key == '':
                 break
 
+        cls.tags.add(kept_ids, kept_vals)
+        cls.discarded_tags.add(lost_ids, lost_vals)
+        if len(file_ids) > 0:
+            cls.for_tags_file.add(data[1], file_ids, file_vals)
+        if cls.sink is not None and data[1] != '':
+            cls.sink_ratings[str(data[1])] = data[3]
+
         if getattr(shared.opts, 'tagger_verbose', True):
             print(f'{data[0]}: {count}/{len(tags)} tags kept')
 
         if fi_key != '':
-            cls.query[fi_key] = (data[0], index)
+            cls.store.add(fi_key, data[0], index, weights)
 
     @classmethod
     def finalize_batch(cls, count: int) -> ItRetTP:
         """ finalize the batch query """
-        if cls.json_db and cls.had_new:
-            cls.write_json()
+        if cls.had_new:
+            cls.write_db()
             cls.had_new = False
 
         # collect the weights per file/interrogation of the prior in db stored.
-        for index in range(2):
-            for ent, lst in cls.weighed[index].items():
-                for i, val in map(cls.get_i_wt, lst):
-                    if i not in cls.in_db:
-                        continue
-                    cls.in_db[i][3+index][ent] = val
+        for i, weights in cls.store.get(cls.in_db.keys()).items():
+            cls.in_db[i][3].update(weights[0])
+            cls.in_db[i][4].update(weights[1])
 
         # process the retrieved from db and add them to the stats
         for got in cls.in_db.values():
@@ -567,6 +633,78 @@ class QData:
         """ sort tags by value, return list of tuples """
         return sorted(tags.items(), key=lambda x: x[1], reverse=True)
 
+    @classmethod
+    def write_tags_file(cls, file: Path, tags: Dict[str, float]) -> None:
+        """ write the tags, sorted by weight, to a tags file """
+        sorted_tags = cls.sort_tags(tags)
+        if cls.sink is not None:
+            # a row of the manifest instead
+            entry = cls.sink_entries.get(str(file), [file, file, ''])
+            cls.sink.add({
+                'path': str(entry[0]),
+                'hash': entry[3] if len(entry) > 3 else '',
+                'model': cls.sink_model,
+                'tags': ', '.join(k for k, v in sorted_tags),
+                'weights': dict(sorted_tags),
+                'ratings': cls.sink_ratings.pop(str(file), {}),
+            })
+            return
+        if getattr(shared.opts, 'tagger_weighted_tags_files', False):
+            sorted_tags = [f'({k}:{v})' for k, v in sorted_tags]
+        else:
+            sorted_tags = [k for k, v in sorted_tags]
+        text = ', '.join(sorted_tags)
+        if cls.writer is None:
+            write_atomic(file, text.encode('utf-8'))
+        else:
+            cls.writer.write(file, text)
+
+    @classmethod
+    @contextmanager
+    def outputs(cls, model: str, labels: Optional[List[str]]):
+        """ the manifest and raw confidences of a batch, if chosen """
+        root = Path(IOData.output_root or '.')
+        cls.sink = open_sink(cls.output_format, root.joinpath('tags'))
+        if cls.sink is not None:
+            cls.sink_model = model
+            cls.sink_entries = {str(x[1]): x for x in IOData.paths
+                                if x[1] != ''}
+        if cls.save_raw:
+            if labels is None:
+                print(f'{model} has no raw confidences to save')
+            else:
+                paths = [str(x[0].absolute()) for x in IOData.paths]
+                cls.raw = RawVectors(root.joinpath('raw'), paths, labels)
+        done = False
+        try:
+            yield
+            done = True
+        finally:
+            outputs = [x for x in [cls.sink, cls.raw] if x is not None]
+            cls.sink, cls.raw = None, None
+            cls.sink_entries, cls.sink_ratings = {}, {}
+            # a failed or interrupted batch leaves the previous outputs
+            for output in outputs:
+                if done:
+                    output.close()
+                else:
+                    output.abort()
+
+    @classmethod
+    @contextmanager
+    def writing(cls):
+        """ write the tags files in worker threads, done at the exit """
+        if cls.writer is not None:
+            yield cls.writer
+            return
+        workers = getattr(shared.opts, 'tagger_write_workers', 4)
+        cls.writer = TagsWriter(workers)
+        try:
+            yield cls.writer
+        finally:
+            writer, cls.writer = cls.writer, None
+            writer.close()
+
     @classmethod
     def get_image_dups(cls) -> List[str]:
         # first sort values so that those without a comma come first
@@ -583,45 +721,40 @@ class QData:
 
         ratings, tags, discarded_tags = {}, {}, {}
 
-        for n in cls.for_tags_file.keys():
-            for k in cls.add_tags:
-                cls.for_tags_file[n][k] = 1.0 * count
-
         for k in cls.add_tags:
             tags[k] = 1.0
 
-        for k, lst in cls.tags.items():
-            # len(!) fraction of the all interrogations was above the threshold
-            fraction_of_queries = len(lst) / count
-
-            if fraction_of_queries >= cls.tag_frac_threshold:
-                # store the average of those interrogations sum(!) / count
-                tags[k] = sum(lst) / count
-                # trigger an event to place the tag in the active tags list
-                # replace if k interferes with html code
-            else:
-                discarded_tags[k] = sum(lst) / count
-                for n in cls.for_tags_file.keys():
-                    if k in cls.for_tags_file[n]:
-                        if k not in cls.add_tags and k not in cls.keep_tags:
-                            del cls.for_tags_file[n][k]
-
-        for k, lst in cls.discarded_tags.items():
-            fraction_of_queries = len(lst) / count
-            discarded_tags[k] = sum(lst) / count
+        names = cls.vocab.name_array()
+        ids = cls.tags.keys()
+        # the fraction of all interrogations that was above the threshold
+        fractions = cls.tags.counts[ids] / count
+        # the average of those interrogations, sum(!) / count
+        averages = cls.tags.sums[ids] / count
+        is_kept = fractions >= cls.tag_frac_threshold
+        tags.update(zip(names[ids[is_kept]].tolist(),
+                        averages[is_kept].tolist()))
+        discarded_tags.update(zip(names[ids[~is_kept]].tolist(),
+                                  averages[~is_kept].tolist()))
+        # these are removed from the tags files, unless kept
+        ids_low = [i for i in ids[~is_kept].tolist()
+                   if names[i] not in cls.keep_tags]
+
+        ids = cls.discarded_tags.keys()
+        discarded_tags.update(zip(
+            names[ids].tolist(),
+            (cls.discarded_tags.sums[ids] / count).tolist()))
 
         for ent, val in cls.ratings.items():
             ratings[ent] = val / count
 
-        weighted_tags_files = getattr(shared.opts,
-                                      'tagger_weighted_tags_files', False)
-        for file, remaining_tags in cls.for_tags_file.items():
-            sorted_tags = cls.sort_tags(remaining_tags)
-            if weighted_tags_files:
-                sorted_tags = [f'({k}:{v})' for k, v in sorted_tags]
-            else:
-                sorted_tags = [k for k, v in sorted_tags]
-            file.write_text(', '.join(sorted_tags), encoding='utf-8')
+        # the tags below the fraction are removed from all tags files at once
+        drop = np.zeros(len(cls.vocab), dtype=bool)
+        drop[ids_low] = True
+        with cls.writing():
+            for file, remaining_tags in cls.for_tags_file.finalize(drop):
+                for k in cls.add_tags:
+                    remaining_tags[k] = 1.0 * count
+                cls.write_tags_file(file, remaining_tags)
 
         warn = ""
         if len(QData.err) > 0:
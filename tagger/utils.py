@@ -6,13 +6,15 @@ from pathlib import Path
 
 from modules import shared, scripts  # pylint: disable=import-error
 from modules.shared import models_path  # pylint: disable=import-error
+from tagger.quantize import VARIANTS  # pylint: disable=import-error
 
 default_ddp_path = Path(models_path, 'deepdanbooru')
 default_onnx_path = Path(models_path, 'TaggerOnnx')
 from tagger.preset import Preset  # pylint: disable=import-error
 from tagger.interrogator import Interrogator, DeepDanbooruInterrogator, \
                                 MLDanbooruInterrogator  # pylint: disable=E0401 # noqa: E501
-from tagger.interrogator import WaifuDiffusionInterrogator  # pylint: disable=E0401 # noqa: E501
+from tagger.interrogator import WaifuDiffusionInterrogator, \
+                                OnnxInterrogator  # pylint: disable=E0401 # noqa: E501
 
 preset = Preset(Path(scripts.basedir(), 'presets'))
 
@@ -90,7 +92,9 @@ def refresh_interrogators() -> List[str]:
             print(f"Warning: {path} is not a directory, skipped")
             continue
 
-        onnx_files = [x for x in os.scandir(path) if x.name.endswith('.onnx')]
+        # .ort.onnx are optimized graphs saved by onnxruntime
+        onnx_files = [x for x in os.scandir(path) if x.name.endswith('.onnx')
+                      and not x.name.endswith('.ort.onnx')]
         if len(onnx_files) != 1:
             print(f"Warning: {path} requires exactly one .onnx model, skipped")
             continue
@@ -124,6 +128,17 @@ def refresh_interrogators() -> List[str]:
         interrogators[path.name].local_model = str(local_path)
         interrogators[path.name].local_tags = str(tags_path)
 
+    # int8 / fp16 variants of the onnx models, created when first loaded
+    variants = split_str(getattr(shared.opts, 'tagger_model_variants', ''))
+    for key, it in list(interrogators.items()):
+        if not isinstance(it, OnnxInterrogator) or it.variant is not None:
+            continue
+        for kind in variants:
+            if kind not in VARIANTS:
+                print(f'Warning: unknown model variant {kind}, skipped')
+            elif f'{key}.{kind}' not in interrogators:
+                interrogators[f'{key}.{kind}'] = it.variant_of(kind)
+
     return sorted(interrogators.keys())
 
 
@@ -0,0 +1,152 @@
+""" Dense integer ids for tag names, and per tag statistics in arrays """
+from itertools import chain
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+
+class Vocabulary:
+    """ tag names to dense integer ids, in order of first use """
+    def __init__(self, names: Iterable[str] = ()) -> None:
+        self.names: List[str] = []
+        self.ids: Dict[str, int] = {}
+        for name in names:
+            self.id(name)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def id(self, name: str) -> int:
+        """ the id of a tag name, a new one for an unknown name """
+        got = self.ids.get(name)
+        if got is None:
+            got = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return got
+
+    def name_array(self) -> np.ndarray:
+        return np.asarray(self.names, dtype=object)
+
+
+class TagStats:
+    """
+    per tag id of a vocabulary: the number of values added and their sum.
+    The ids are also kept in order of their first value, for the output.
+    """
+    def __init__(self, vocab: Vocabulary) -> None:
+        self.vocab = vocab
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.sums = np.zeros(0, dtype=np.float64)
+        self.order: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def __contains__(self, tag_id: int) -> bool:
+        return tag_id < len(self.counts) and self.counts[tag_id] > 0
+
+    def grow(self) -> None:
+        """ make room for all ids of the vocabulary """
+        size = len(self.vocab)
+        if size > len(self.counts):
+            # amortized, as for a list
+            size = max(size, 2 * len(self.counts))
+            pad = size - len(self.counts)
+            self.counts = np.concatenate([self.counts,
+                                          np.zeros(pad, np.int64)])
+            self.sums = np.concatenate([self.sums, np.zeros(pad, np.float64)])
+
+    def add(self, ids: List[int], values: List[float]) -> None:
+        """ add a value per id, an id may occur more than once """
+        if len(ids) == 0:
+            return
+        self.grow()
+        self.order.extend(i for i in dict.fromkeys(ids)
+                          if self.counts[i] == 0)
+        ids = np.asarray(ids, dtype=np.int64)
+        np.add.at(self.counts, ids, 1)
+        np.add.at(self.sums, ids, np.asarray(values, dtype=np.float64))
+
+    def keys(self) -> np.ndarray:
+        """ the ids with values, in order of their first value """
+        return np.asarray(self.order, dtype=np.int64)
+
+    def clear(self) -> None:
+        self.counts[:] = 0
+        self.sums[:] = 0.0
+        self.order = []
+
+
+class TagsFiles:
+    """
+    the tag ids and weights per tags file, in the order they were added. The
+    weights of a tag that is added more than once add up, to at most 1.0.
+    """
+    def __init__(self, vocab: Vocabulary) -> None:
+        self.vocab = vocab
+        self.files: Dict[Any, Tuple[List[int], List[float]]] = {}
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def __iter__(self) -> Iterator:
+        return iter(self.files)
+
+    def add(self, file, ids: List[int], values: List[float]) -> None:
+        got = self.files.get(file)
+        if got is None:
+            self.files[file] = (list(ids), list(values))
+        else:
+            got[0].extend(ids)
+            got[1].extend(values)
+
+    def pop(self, file) -> Dict[str, float]:
+        """ remove the tags of one file, as tag name -> weight """
+        ids, values = self.files.pop(file, ([], []))
+        tags = {}
+        for tag_id, val in zip(ids, values):
+            name = self.vocab.names[tag_id]
+            tags[name] = min(val + tags.get(name, 0.0), 1.0)
+        return tags
+
+    def clear(self) -> None:
+        self.files.clear()
+
+    def finalize(self, drop: np.ndarray) -> Iterator[Tuple[Any,
+                                                          Dict[str, float]]]:
+        """
+        the tags per file, as tag name -> weight, without the tags where
+        drop, a boolean per id, is set. All files are processed at once.
+        """
+        files = list(self.files.keys())
+        lengths = np.fromiter((len(x[0]) for x in self.files.values()),
+                              np.int64, len(files))
+        total = int(lengths.sum())
+        ids = np.fromiter(chain.from_iterable(
+            x[0] for x in self.files.values()), np.int64, total)
+        values = np.fromiter(chain.from_iterable(
+            x[1] for x in self.files.values()), np.float64, total)
+        rows = np.repeat(np.arange(len(files), dtype=np.int64), lengths)
+
+        # merge the repeated tags of a file, in order of their first weight
+        _, first, inverse = np.unique(rows * max(len(self.vocab), 1) + ids,
+                                      return_index=True, return_inverse=True)
+        sums = np.bincount(inverse.ravel(), weights=values,
+                           minlength=len(first))
+        order = np.argsort(first, kind='stable')
+        rows, ids = rows[first[order]], ids[first[order]]
+        weights = np.minimum(sums[order], 1.0)
+
+        if len(drop) < len(self.vocab):
+            drop = np.concatenate([drop, np.zeros(len(self.vocab) - len(drop),
+                                                  dtype=bool)])
+        kept = ~drop[ids]
+        rows, ids, weights = rows[kept], ids[kept], weights[kept]
+
+        names = self.vocab.name_array()[ids].tolist()
+        weights = weights.tolist()
+        ends = np.cumsum(np.bincount(rows, minlength=len(files))).tolist()
+        start = 0
+        for file, end in zip(files, ends):
+            yield file, dict(zip(names[start:end], weights[start:end]))
+            start = end
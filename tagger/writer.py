@@ -0,0 +1,76 @@
+""" Writes tags files in worker threads, each one atomically """
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from threading import BoundedSemaphore, Lock, get_ident
+from time import perf_counter
+from typing import List
+
+
+def write_atomic(path: Path, data: bytes) -> bool:
+    """ write through a temporary file, unless unchanged; True if written """
+    try:
+        if path.stat().st_size == len(data) and path.read_bytes() == data:
+            return False
+    except OSError:
+        pass
+    # unique per thread as well, the same file may be written concurrently;
+    # not mkstemp, its files are private to the user
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}.{get_ident()}.tmp')
+    try:
+        with open(tmp, 'wb') as file:
+            file.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return True
+
+
+class TagsWriter:
+    """
+    writes tags files in a bounded thread pool: at most workers files are
+    written at once, and as many wait; write() blocks while more do.
+    """
+    def __init__(self, workers: int) -> None:
+        workers = max(int(workers), 1)
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='tagger-tw')
+        self.slots = BoundedSemaphore(2 * workers)
+        self.lock = Lock()
+        self.errors: List[BaseException] = []
+        self.written = 0
+        self.unchanged = 0
+        self.size = 0
+        self.start = perf_counter()
+
+    def write(self, path: Path, text: str) -> None:
+        data = text.encode('utf-8')
+        self.slots.acquire()
+        try:
+            future = self.pool.submit(write_atomic, path, data)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.done(f, len(data)))
+
+    def done(self, future: Future, size: int) -> None:
+        self.slots.release()
+        with self.lock:
+            if future.exception() is not None:
+                self.errors.append(future.exception())
+            elif future.result():
+                self.written += 1
+                self.size += size
+            else:
+                self.unchanged += 1
+
+    def close(self) -> None:
+        """ wait for the pending writes, raise the first error if any """
+        self.pool.shutdown(wait=True)
+        seconds = perf_counter() - self.start
+        if self.written + self.unchanged > 0:
+            print(f'Wrote {self.written} tags files ({self.size >> 10} KiB, '
+                  f'{self.unchanged} unchanged) in {seconds:.2f}s, '
+                  f'{self.written / max(seconds, 1e-6):.0f} files/s')
+        if len(self.errors) > 0:
+            raise self.errors[0]
@@ -0,0 +1,133 @@
+""" Tests of the interrogation queues of the api, these need the webui """
+import asyncio
+from io import BytesIO
+from json import loads
+from threading import Lock
+
+import pytest
+
+pytest.importorskip('modules.api.api', reason='needs the webui modules')
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from PIL import Image  # noqa: E402
+from tagger import utils  # noqa: E402
+from tagger.api import Api  # noqa: E402
+
+
+def make_api() -> Api:
+    """ an api that tags image i as i, after i centiseconds """
+    api = Api(FastAPI(), Lock(), '/tagger/v1')
+
+    async def interrogate(m, i, t):
+        await asyncio.sleep(int(i) / 100)
+        return {'rating': {'general': .5}, 'tag': {i: .9}}
+
+    api.interrogate = interrogate
+    return api
+
+
+def assert_dropped(api: Api, q: str):
+    for state in [api.res, api.pending, api.tasks, api.last_used,
+                  api.running_batches['m']]:
+        assert q not in state
+
+
+def test_concurrent_final_call():
+    api = make_api()
+
+    async def run():
+        calls = [api.queue_interrogation('m', 'q', f'n{i}', str(i))
+                 for i in range(4)]
+        # sent along with the images, still answered after them
+        calls.append(api.queue_interrogation('m', 'q'))
+        return await asyncio.gather(*calls)
+
+    res = asyncio.run(run())[-1]
+    assert sorted(res) == ['n0', 'n1', 'n2', 'n3']
+    assert res['n2'] == {'2': .9, 'rating:general': .5}
+    assert_dropped(api, 'q')
+
+
+def test_image_queued_after_final_call():
+    api = make_api()
+
+    async def run():
+        first = asyncio.ensure_future(api.queue_interrogation('m', 'q', 'a',
+                                                              '1'))
+        final = asyncio.ensure_future(api.queue_interrogation('m', 'q'))
+        await asyncio.sleep(0)
+        late = asyncio.ensure_future(api.queue_interrogation('m', 'q', 'b',
+                                                             '3'))
+        res = await final
+        # the late image keeps the queue until the next final request
+        assert 'q' in api.last_used
+        await asyncio.gather(first, late)
+        assert api.res['q'] == {'b': {'3': .9, 'rating:general': .5}}
+        return res, await api.queue_interrogation('m', 'q')
+
+    res, last = asyncio.run(run())
+    assert list(res) == ['a']
+    assert list(last) == ['b']
+    assert_dropped(api, 'q')
+
+
+def test_stream_reports_errors():
+    api = make_api()
+
+    async def interrogate(m, i, t):
+        if i == 'bad':
+            raise ValueError('not an image')
+        return {'rating': {}, 'tag': {i: .9}}
+
+    async def run():
+        api.streams['q'] = asyncio.Queue()
+        for n, image in [('a', 'a'), ('b', 'bad')]:
+            try:
+                await api.queue_interrogation('m', 'q', n, image)
+            except ValueError:
+                pass
+        await api.queue_interrogation('m', 'q')
+        return [loads(x) async for x in api.stream_queue('q', False)]
+
+    api.interrogate = interrogate
+    assert asyncio.run(run()) == [
+        {'name': 'a', 'caption': {'a': .9}},
+        {'name': 'b', 'error': "ValueError('not an image')"},
+    ]
+    assert_dropped(api, 'q')
+
+
+class WidthInterrogator:
+    """ tags an image with its width, images below 4 pixels fail """
+    model = None
+
+    def preprocess(self, image):
+        if image.width < 4:
+            raise ValueError('too small')
+        return image.width
+
+    def run_batch(self, inputs, full=False):
+        return [({'general': .5}, {str(x): .9}) for x in inputs]
+
+
+def png(width: int) -> bytes:
+    buf = BytesIO()
+    Image.new('RGB', (width, 8), 'white').save(buf, 'PNG')
+    return buf.getvalue()
+
+
+def test_batch_upload_reports_errors_per_image(monkeypatch):
+    monkeypatch.setitem(utils.interrogators, 'w', WidthInterrogator())
+    app = FastAPI()
+    Api(app, Lock(), '/tagger/v1')
+    files = [('images', (f'{x}.png', png(x), 'image/png')) for x in [8, 2, 6]]
+    res = TestClient(app).post('/tagger/v1/interrogate-batch',
+                               data={'model': 'w'}, files=files)
+    assert res.status_code == 200
+    assert [(x['name'], x['caption'], x['error'])
+            for x in res.json()['results']] == [
+        ('8.png', {'rating': {'general': .5}, 'tag': {'8': .9}}, None),
+        ('2.png', None, "ValueError('too small')"),
+        ('6.png', {'rating': {'general': .5}, 'tag': {'6': .9}}, None),
+    ]
@@ -0,0 +1,60 @@
+""" Tests of the micro batching of API interrogations """
+from concurrent.futures import wait
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from tagger.batcher import MicroBatcher
+
+
+def png(size=64) -> bytes:
+    buf = BytesIO()
+    Image.effect_noise((size, size), 64).save(buf, 'PNG')
+    return buf.getvalue()
+
+
+def submit_all(process, images):
+    """ the futures of the images, all in one batch """
+    batches = []
+
+    def record(model, items):
+        batches.append(len(items))
+        return process(model, items)
+
+    batcher = MicroBatcher(record, lambda: len(images), lambda: 5.0)
+    futures = [batcher.submit('m', x, 0.5) for x in images]
+    wait(futures, timeout=10)
+    return futures, batches
+
+
+def test_failing_batch_is_retried_per_image():
+    # decoded lazily, only loading the truncated image fails
+    data = png()
+    images = [Image.open(BytesIO(x)) for x in [data, data[:len(data) // 2],
+                                               data]]
+
+    def size(image: Image.Image):
+        image.load()
+        return image.size
+
+    def process(model, items):
+        return [size(image) for image, _ in items]
+
+    futures, batches = submit_all(process, images)
+    assert futures[0].result() == (64, 64)
+    with pytest.raises(OSError):
+        futures[1].result()
+    assert futures[2].result() == (64, 64)
+    assert batches == [3, 1, 1, 1]
+
+
+def test_exception_result_fails_one_future():
+    def process(model, items):
+        return [ValueError(x) if x == 'bad' else x.upper() for x, _ in items]
+
+    futures, batches = submit_all(process, ['a', 'bad', 'c'])
+    assert [futures[0].result(), futures[2].result()] == ['A', 'C']
+    with pytest.raises(ValueError):
+        futures[1].result()
+    assert batches == [3]
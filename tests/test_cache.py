@@ -0,0 +1,30 @@
+""" Tests of the cache of raw model outputs, these need the webui """
+import numpy as np
+import pytest
+
+pytest.importorskip('modules.shared', reason='needs the webui modules')
+
+from tagger import cache  # noqa: E402
+
+
+def test_cache_grows_up_to_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, 'INITIAL_ROWS', 2)
+    store = cache.ConfidenceCache(tmp_path / 'c', 3, 5)
+    assert store.capacity == 2
+    assert (tmp_path / 'c.f16').stat().st_size == 2 * 3 * 2
+
+    rows = {f'h{i}': np.full(3, i / 8, np.float32) for i in range(6)}
+    for i, (key, val) in enumerate(rows.items()):
+        store.put(key, val)
+        assert store.capacity == [2, 2, 4, 4, 5, 5][i]
+    store.flush()
+    assert (tmp_path / 'c.f16').stat().st_size == 5 * 3 * 2
+
+    # full: the least recently used row was evicted
+    assert store.get('h0') is None
+    assert store.get('h3').tolist() == rows['h3'].tolist()
+
+    store = cache.ConfidenceCache(tmp_path / 'c', 3, 5)
+    assert store.capacity == 5
+    assert sorted(store.rows) == ['h1', 'h2', 'h3', 'h4', 'h5']
+    assert store.get('h1').tolist() == rows['h1'].tolist()
@@ -0,0 +1,35 @@
+""" Tests of the consolidated outputs of a batch """
+import numpy as np
+
+from tagger.sinks import JsonlSink, RawVectors
+
+
+def row(path: str):
+    return {'path': path, 'weights': {'cat': .9}, 'ratings': {}}
+
+
+def test_abort_keeps_previous_manifest(tmp_path):
+    sink = JsonlSink(tmp_path / 'tags', rows_per_write=1)
+    sink.add(row('a'))
+    sink.close()
+    done = (tmp_path / 'tags.jsonl').read_text(encoding='utf-8')
+
+    sink = JsonlSink(tmp_path / 'tags', rows_per_write=1)
+    sink.add(row('b'))
+    sink.abort()
+    assert (tmp_path / 'tags.jsonl').read_text(encoding='utf-8') == done
+    assert sorted(x.name for x in tmp_path.iterdir()) == ['tags.jsonl']
+
+
+def test_abort_keeps_previous_raw_vectors(tmp_path):
+    raw = RawVectors(tmp_path / 'raw', ['a', 'b'], ['x'])
+    raw.put('a', [.5])
+    raw.put('b', [.25])
+    raw.close()
+
+    raw = RawVectors(tmp_path / 'raw', ['a', 'b'], ['x'])
+    raw.put('a', [1.0])
+    raw.abort()
+    assert np.load(tmp_path / 'raw.npy').tolist() == [[.5], [.25]]
+    assert sorted(x.name for x in tmp_path.iterdir()) == ['raw.json',
+                                                          'raw.npy']
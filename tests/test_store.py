@@ -0,0 +1,54 @@
+""" Tests of the interrogation stores """
+from tagger.store import JsonStore, SQLiteStore
+
+
+def v1(query, rating, tag):
+    """ a db.json, with the weights per index encoded as in the lists """
+    return {
+        "query": query,
+        "rating": {k: [i + w for i, w in lst] for k, lst in rating.items()},
+        "tag": {k: [i + w for i, w in lst] for k, lst in tag.items()},
+    }
+
+
+def test_import_into_non_empty_sqlite(tmp_path):
+    store = SQLiteStore(tmp_path / 'db.sqlite')
+    store.add('a', '/a.png', 0, ({'general': .9}, {'cat': .8}))
+    store.add('b', '/b.png', 1, ({'general': .7}, {'dog': .6}))
+    store.write()
+
+    store = SQLiteStore(tmp_path / 'db.sqlite')
+    store.import_v1(v1({'c': ['/c.png', 0]}, {'explicit': [(0, .5)]},
+                       {'bird': [(0, .4)]}))
+
+    store = SQLiteStore(tmp_path / 'db.sqlite')
+    assert store.query['a'] == ('/a.png', 0)
+    assert store.query['c'] == ('/c.png', 2)
+    got = store.get([0, 1, 2])
+    assert got[0] == ({'general': .9}, {'cat': .8})
+    assert got[1] == ({'general': .7}, {'dog': .6})
+    assert got[2][0] == {'explicit': .5}
+    assert got[2][1] == {'bird': .4}
+    assert store.next_index() == 3
+
+
+def test_import_replaces_same_fi_key(tmp_path):
+    store = SQLiteStore(tmp_path / 'db.sqlite')
+    store.add('a', '/a.png', 0, ({'general': .9}, {'cat': .8}))
+    store.write()
+
+    store.import_v1(v1({'a': ['/a.png', 0]}, {}, {'dog': [(0, .3)]}))
+    store = SQLiteStore(tmp_path / 'db.sqlite')
+    index = store.query['a'][1]
+    assert index == 1
+    assert store.get([0, 1]) == {0: ({}, {}), 1: ({}, {'dog': .3})}
+    assert store.next_index() == 2
+
+
+def test_json_store_keeps_weights(tmp_path):
+    store = JsonStore(tmp_path / 'db.json')
+    store.import_v1(v1({'a': ['/a.png', 0]}, {'general': [(0, .4)]},
+                       {'cat': [(0, .3)]}))
+    store.add('b', '/b.png', 1, ({'general': .4}, {'dog': .1}))
+    assert store.get([0, 1]) == {0: ({'general': .4}, {'cat': .3}),
+                                 1: ({'general': .4}, {'dog': .1})}